@@ -0,0 +1,376 @@
+"""Phaser throughput and latency benchmarks in `migen.sim`.
+
+Simulates the full `Phaser` gateware with the Xilinx primitives replaced
+by behavioral models (`sim_overrides`) and writes the results to a JSON
+file. Compare two result files with `--compare`.
+
+Clock periods are in ns: SCK 8 (125 MHz), `dac_clk` 32 (125 MS/s).
+"""
+import argparse
+import json
+import os
+import subprocess
+import time
+
+from migen import *
+from migen.fhdl.specials import Instance
+from migen.genlib.io import DifferentialInput, DifferentialOutput
+from migen.sim import passive
+
+from phaser import Phaser
+from phaser_impl import Platform
+from memory_contents import memory_contents
+
+
+class _SimFDCPE(Module):
+    def __init__(self, instance):
+        items = {item.name: item for item in instance.items}
+        init = items["INIT"].value
+        d, ce, pre, clr, q = [items[name].expr
+                              for name in ("D", "CE", "PRE", "CLR", "Q")]
+        r = Signal(reset=init, reset_less=True)
+        sync = getattr(self.sync, items["C"].expr.cd)
+        sync += If(clr,
+            r.eq(0),
+        ).Elif(pre,
+            r.eq(1),
+        ).Elif(ce,
+            r.eq(d),
+        )
+        self.comb += q.eq(Mux(clr, 0, Mux(pre, 1, r)))
+
+
+class _SimInstance:
+    """FDCPE (`AsyncRst`) with asynchronous set/clear as seen at the clock
+    edges of the free running simulation clocks, PLL always locked. All
+    other primitives (buffers, OSERDES, GTP clock buffers) are dropped,
+    their clocks come from the simulator."""
+    @staticmethod
+    def lower(instance):
+        if instance.of == "FDCPE":
+            return _SimFDCPE(instance)
+        m = Module()
+        if instance.of == "PLLE2_BASE":
+            for item in instance.items:
+                if item.name == "LOCKED":
+                    m.comb += item.expr.eq(1)
+        return m
+
+
+class _SimDifferentialInput:
+    @staticmethod
+    def lower(dr):
+        m = Module()
+        m.comb += dr.o.eq(dr.i_p)
+        return m
+
+
+class _SimDifferentialOutput:
+    @staticmethod
+    def lower(dr):
+        m = Module()
+        m.comb += [dr.o_p.eq(dr.i), dr.o_n.eq(~dr.i)]
+        return m
+
+
+sim_overrides = {
+    Instance: _SimInstance,
+    DifferentialInput: _SimDifferentialInput,
+    DifferentialOutput: _SimDifferentialOutput,
+}
+
+T_SCK = 8
+T_DAC = 32
+clocks = {
+    "sck": T_SCK,
+    "sys": (T_SCK, T_SCK//2),
+    "reg": (T_SCK, T_SCK//2),
+    "dac_clk": T_DAC,
+    "dac_clk_nr": T_DAC,
+    "dac_clk4x": T_DAC//4,
+    "clk125_div2": 16,
+    "clk_gtp_div2": 16,
+}
+
+
+class Clock:
+    """Time (ns) of the `cd` rising edge a generator is at.
+
+    Generator step `n` runs at the `n`-th rising edge: reads see the
+    values from before the edge, writes take effect at the edge.
+    """
+    def __init__(self, cd):
+        period, phase = clocks[cd], 0
+        if isinstance(period, tuple):
+            period, phase = period
+        # migen.sim starts a clock high if `phase >= period/2`
+        if phase >= period//2:
+            self.first = period - (phase - period//2)
+        else:
+            self.first = period//2 - phase
+        self.period = period
+        self.now = self.first
+
+    def tick(self, n=1):
+        for _ in range(n):
+            yield
+            self.now += self.period
+
+    def edges(self, t0, t1):
+        """Number of rising edges in `(t0, t1]`."""
+        return ((t1 - self.first)//self.period -
+                (t0 - self.first)//self.period)
+
+
+class PhaserSim:
+    """Simulation harness: SPI master in the `sys` domain (MOSI and CS
+    change after the falling SCK edge) and the probed pads."""
+    def __init__(self, pattern="sin", **kwargs):
+        self.platform = Platform()
+        self.dut = Phaser(self.platform, memory_contents[pattern], **kwargs)
+        lvds = [self.platform.lookup_request("lvds", i) for i in range(6)]
+        self.mosi, self.miso, self.cs = lvds[1].p, lvds[2].p, lvds[3].p
+        self.sync, self.trig = lvds[4].p, lvds[5].p
+        self.istr = self.platform.lookup_request("dac_istr_p")
+        self.sys = Clock("sys")
+        self.last_sck = None  # last SCK rising edge of a frame
+
+    def frame(self, word, length=24, gap=2):
+        """Shift `word` MSB first, return the bits read back."""
+        readback = 0
+        yield self.cs.eq(1)
+        for i in reversed(range(length)):
+            yield self.mosi.eq((word >> i) & 1)
+            self.last_sck = self.sys.now + T_SCK//2
+            yield from self.sys.tick()
+            readback = readback << 1 | (yield self.miso)
+        yield self.cs.eq(0)
+        yield self.mosi.eq(0)
+        yield from self.sys.tick(gap)
+        return readback
+
+    def run(self, generators):
+        t0 = time.perf_counter()
+        run_simulation(self.dut, generators, clocks=clocks,
+                       special_overrides=sim_overrides)
+        return time.perf_counter() - t0
+
+
+def spi_word(adr, dat=0, we=False):
+    return adr << 17 | we << 16 | dat
+
+
+def bench_sr(gaps=(0, 1, 2, 4), n=8):
+    """Back to back REG1 writes with read back at a given CS gap."""
+    results = {}
+    wall = sim_ns = 0
+    for gap in gaps:
+        sim = PhaserSim()
+        errors = []
+
+        def gen():
+            yield from sim.sys.tick(4)
+            for i in range(n):
+                value = (0x55 + 37*i) & 0x1ff
+                yield from sim.frame(spi_word(1, value, we=True), gap=gap)
+                readback = yield from sim.frame(spi_word(1), gap=gap)
+                if readback & 0x1ff != value:
+                    errors.append(i)
+        wall += sim.run({"sys": gen()})
+        sim_ns += sim.sys.now
+        results[gap] = not errors
+    gap = min(g for g, ok in results.items() if ok)
+    return {
+        "min_cs_gap": gap,
+        "frames_per_sck": 1/(24 + gap),
+        "reg_write_mbit_s": 16e3/((24 + gap)*T_SCK),
+        "gap_ok": {str(g): ok for g, ok in results.items()},
+    }, wall, sim_ns
+
+
+# pass-through targets, name: (address, LE pin, data pin), pins
+# (active low enable) are `(name, number)` or `name`
+ext_targets = {
+    "dac":  (5, "dac_sdenb", "dac_sdio"),
+    "trf0": (6, ("trf_le", 0), ("trf_data", 0)),
+    "trf1": (7, ("trf_le", 1), ("trf_data", 1)),
+    "att0": (8, ("att_le", 0), ("att_s_in", 0)),
+    "att1": (9, ("att_le", 1), ("att_s_in", 1)),
+}
+
+
+def bench_ext(payload=32, gap=2):
+    """Pass-through to each of DAC, TRF0/1 and ATT0/1: payload bits seen
+    on the pins per frame bit. Only the addressed enable may go low."""
+    word = 0xa5c3f00f
+    pins_ok = {}
+    wall = sim_ns = 0
+    for name, (adr, _, _) in ext_targets.items():
+        sim = PhaserSim()
+        pins = {}
+        for target, (_, le, data) in ext_targets.items():
+            le, data = [sim.platform.lookup_request(*p) if isinstance(p, tuple)
+                        else sim.platform.lookup_request(p) for p in (le, data)]
+            pins[target] = le, data
+        seen = []
+        selected = set()
+
+        def gen():
+            yield from sim.sys.tick(4)
+            header = spi_word(adr) >> 16
+            yield from sim.frame(header << payload | word, 8 + payload,
+                                 gap=gap)
+
+        @passive
+        def monitor():
+            sck = Clock("sck")
+            while True:
+                for target, (le, data) in pins.items():
+                    if not (yield le):
+                        selected.add(target)
+                        if target == name:
+                            seen.append((yield data))
+                yield from sck.tick()
+
+        wall += sim.run({"sys": gen(), "sck": monitor()})
+        sim_ns += sim.sys.now
+        bits = sum(b << i for i, b in enumerate(reversed(seen[-payload:])))
+        pins_ok[name] = bits == word and selected == {name}
+    frame = 8 + payload + gap
+    return {
+        "payload_bits": payload,
+        "frame_sck": frame,
+        "efficiency": payload/frame,
+        "pins_ok": pins_ok,
+    }, wall, sim_ns
+
+
+def bench_play(start=None):
+    """Latency to DAC_ISTR in `dac_clk` cycles: rising edges after the
+    last SCK edge of the REG2 write up to and including the one that
+    sets DAC_ISTR, or after the edge that drives the `"trig"` or `"sync"`
+    pad high."""
+    sim = PhaserSim()
+    dac = Clock("dac_clk")
+    marks = {}
+    reg2 = 1 << 4 | 1  # DAC_PLAY, DAC_TXENA
+    pad = None
+    if start == "trig":
+        reg2 |= 1 << 8  # TRIG_START
+        pad = sim.trig
+    elif start == "sync":
+        reg2 |= 1 << 7  # DAC_SYNCen
+        pad = sim.sync
+
+    def gen():
+        yield from sim.sys.tick(4)
+        yield from sim.frame(spi_word(2, reg2, we=True))
+        marks["write"] = sim.last_sck
+
+    def pads():
+        while "istr" not in marks and dac.now < 200*T_DAC:
+            if pad is not None and "write" in marks and start not in marks \
+                    and dac.now > marks["write"] + 8*T_DAC:
+                yield pad.eq(1)
+                marks[start] = dac.now
+            elif start in marks:
+                yield pad.eq(0)
+            yield from dac.tick()
+            if (yield sim.istr):
+                marks["istr"] = dac.now - T_DAC
+        marks["end"] = dac.now
+
+    wall = sim.run({"sys": gen(), "dac_clk": pads()})
+    latency = None
+    if "istr" in marks:
+        latency = dac.edges(marks.get(start, marks["write"]), marks["istr"])
+    return {"latency_dac_clk": latency}, wall, marks["end"]
+
+
+def bench_trig_hold(width=16):
+    """`dac_clk` cycles with DAC_ISTR high for one TRIG pulse of `width`
+    cycles with TRIG_START (one per restart: 1 for a single start, `width`
+    if TRIG restarted on every cycle it is high)."""
+    sim = PhaserSim()
+    dac = Clock("dac_clk")
+    reg2 = 1 << 8 | 1 << 4 | 1  # TRIG_START, DAC_PLAY, DAC_TXENA
+    marks = {}
+    istr_cycles = 0
+
+    def gen():
+        yield from sim.sys.tick(4)
+        yield from sim.frame(spi_word(2, reg2, we=True))
+        marks["write"] = sim.last_sck
+
+    def pads():
+        nonlocal istr_cycles
+        for i in range(64):
+            started = "write" in marks and dac.now > marks["write"] + 8*T_DAC
+            if started and "trig" not in marks:
+                marks["trig"] = i
+            yield sim.trig.eq(started and i < marks["trig"] + width)
+            yield from dac.tick()
+            istr_cycles += yield sim.istr
+
+    wall = sim.run({"sys": gen(), "dac_clk": pads()})
+    return {"width_dac_clk": width, "istr_cycles": istr_cycles}, wall, dac.now
+
+
+def run_all():
+    results = {}
+    wall = sim_ns = 0
+    for name, bench in [
+            ("sr", bench_sr),
+            ("ext", bench_ext),
+            ("play_start", bench_play),
+            ("trig_start", lambda: bench_play("trig")),
+            ("sync_start", lambda: bench_play("sync")),
+            ("trig_hold", bench_trig_hold)]:
+        result, w, ns = bench()
+        results[name] = result
+        wall += w
+        sim_ns += ns
+    results["sim"] = {
+        "wall_s": wall,
+        "sim_us": sim_ns/1e3,
+        "wall_s_per_sim_us": wall/(sim_ns/1e3),
+    }
+    return results
+
+
+def _flatten(d, prefix=""):
+    for k, v in d.items():
+        if isinstance(v, dict):
+            yield from _flatten(v, prefix + k + ".")
+        else:
+            yield prefix + k, v
+
+
+def compare(old, new):
+    old = dict(_flatten(old["results"]))
+    for k, v in _flatten(new["results"]):
+        if old.get(k) != v:
+            print("{}: {} -> {}".format(k, old.get(k), v))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phaser simulation benchmarks")
+    parser.add_argument("-o", "--output", default="bench.json",
+                        help="result file")
+    parser.add_argument("--compare", help="earlier result file")
+    args = parser.parse_args()
+    try:
+        rev = subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = None
+    data = {"rev": rev, "results": run_all()}
+    with open(args.output, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), data)
+    else:
+        print(json.dumps(data, indent=2, sort_keys=True))
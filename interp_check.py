@@ -0,0 +1,95 @@
+"""NumPy reference model of the Phaser `Interpolator`.
+
+`interpolate()` is bit exact to the gateware. Run as a script to check
+the Migen `Interpolator` against it in simulation and to print the image
+rejection of the filter.
+"""
+import argparse
+
+import numpy as np
+
+from phaser import Interpolator, interpolation_taps
+
+
+def interpolate(x, rate, taps=6):
+    """Interpolate the signed 16 bit samples `x` by `rate` (history of
+    zeros before `x[0]`)."""
+    h = np.array(interpolation_taps(rate, taps), dtype=np.int64)
+    x = np.concatenate([np.zeros(taps - 1, dtype=np.int64),
+                        np.asarray(x, dtype=np.int64)])
+    y = np.zeros((len(x) - taps + 1, rate), dtype=np.int64)
+    for p in range(rate):
+        for k in range(taps):
+            y[:, p] += h[p + rate*k]*x[taps - 1 - k:len(x) - k]
+    y = (y + (1 << 15)) >> 16
+    return np.clip(y, -0x8000, 0x7fff).ravel()
+
+
+def image_rejection(rate, taps=6, n=4096):
+    """Worst image level relative to the passband (0 to 0.4 of the input
+    Nyquist frequency), in dB."""
+    h = np.array(interpolation_taps(rate, taps))/(1 << 16)/rate
+    f = np.arange(n)/(2*n)  # output sample rate units
+    resp = np.abs(np.exp(-2j*np.pi*np.outer(f, np.arange(len(h)))) @ h)
+    passband = resp[f <= 0.4/(2*rate)].min()
+    stop = resp[f >= 0.8/rate].max()
+    return 20*np.log10(stop/passband)
+
+
+def simulate(x, rate, taps=6):
+    """Run `x` through the Migen `Interpolator`, return the output
+    samples from the first row on."""
+    from migen import run_simulation
+
+    dut = Interpolator(rate, taps, cd="sys")
+    rows = [int(sum((int(v) & 0xffff) << 16*k for k, v in enumerate(x[i:i + 4])))
+            for i in range(0, len(x), 4)]
+    out = []
+
+    def gen():
+        yield dut.start.eq(1)
+        yield
+        yield dut.start.eq(0)
+        yield
+        for row in rows:
+            for _ in range(rate):
+                yield dut.i.eq(row)
+                yield
+        for _ in range(Interpolator.latency):
+            yield
+
+    def mon():
+        # writes take effect after the next edge: first row at `i` after 3
+        for _ in range(3 + Interpolator.latency):
+            yield
+        for _ in range(rate*len(rows)):
+            o = yield dut.o
+            out.extend((o >> 16*k) & 0xffff for k in range(4))
+            yield
+
+    run_simulation(dut, [gen(), mon()])
+    out = np.array(out, dtype=np.int64)
+    return np.where(out >= 0x8000, out - 0x10000, out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phaser interpolator check")
+    parser.add_argument("--taps", type=int, default=6)
+    parser.add_argument("-n", type=int, default=64, help="input samples")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    t = np.arange(args.n)
+    x = np.clip(np.round(0x7000*np.sin(2*np.pi*0.07*t) +
+                         rng.integers(-0x1000, 0x1000, args.n)),
+                -0x8000, 0x7fff).astype(np.int64)
+    x[args.n//2] = 0x7fff  # saturation
+    x[args.n//2 + 1] = -0x8000
+    ok = True
+    for rate in (2, 4, 8):
+        ref = interpolate(x, rate, args.taps)
+        sim = simulate(x, rate, args.taps)
+        mismatches = np.count_nonzero(ref != sim)
+        ok &= mismatches == 0
+        print("{}x: {} mismatches in {} samples, images {:.1f} dB".format(
+            rate, mismatches, len(ref), image_rejection(rate, args.taps)))
+    raise SystemExit(0 if ok else 1)
@@ -22,6 +22,7 @@ memory_contents = {
     }
 }
 
+from binascii import crc32
 from math import sin, pi
 
 def chunks(lst, n):
@@ -34,6 +35,75 @@ def to_mem_row(vals):
         out |= v << (i*16)
     return out
 
+# Compressed patterns (`Phaser(compress=True)`), one 72 bit entry per run:
+# (DELTA[71]) (N[70:64]) (PAYLOAD[63:0])
+# DELTA=0: PAYLOAD is a row, repeated N+1 times
+# DELTA=1: PAYLOAD is added lane-wise (mod 2**16) to the previous row, N+1 times
+ENTRY_DELTA = 1 << 71
+ENTRY_RUN = 128
+
+def _lanes(row):
+    return [(row >> (16*i)) & 0xffff for i in range(4)]
+
+def _row_sub(a, b):
+    return to_mem_row([(x - y) & 0xffff for x, y in zip(_lanes(a), _lanes(b))])
+
+def _row_add(a, b):
+    return to_mem_row([(x + y) & 0xffff for x, y in zip(_lanes(a), _lanes(b))])
+
+def encode_rows(rows, max_run=ENTRY_RUN):
+    """Run length and delta encode 64 bit rows.
+
+    Greedy: at each row, take the longer of a run of identical rows and a
+    run of rows with constant lane-wise difference to the previous one.
+    The first entry is always a row. Returns the list of 72 bit entries.
+    """
+    entries = []
+    prev = None
+    i = 0
+    while i < len(rows):
+        n_raw = 1
+        while (i + n_raw < len(rows) and n_raw < max_run
+                and rows[i + n_raw] == rows[i]):
+            n_raw += 1
+        n_delta = 0
+        if prev is not None:
+            delta = _row_sub(rows[i], prev)
+            n_delta = 1
+            while (i + n_delta < len(rows) and n_delta < max_run
+                    and _row_sub(rows[i + n_delta], rows[i + n_delta - 1]) == delta):
+                n_delta += 1
+        if n_delta > n_raw:
+            entries.append(ENTRY_DELTA | (n_delta - 1) << 64 | delta)
+            i += n_delta
+        else:
+            entries.append((n_raw - 1) << 64 | rows[i])
+            i += n_raw
+        prev = rows[i - 1]
+    return entries
+
+def decode_rows(entries):
+    """Reference decoder for `encode_rows()` entries."""
+    rows = []
+    for entry in entries:
+        payload = entry & ((1 << 64) - 1)
+        for _ in range(((entry >> 64) & 0x7f) + 1):
+            if entry & ENTRY_DELTA:
+                rows.append(_row_add(rows[-1], payload))
+            else:
+                rows.append(payload)
+    return rows
+
+def pattern_crc(words, width=64):
+    """CRC-32 of memory words as reported by the `PatternCRC` registers.
+
+    `words` are the stored words of one channel: the rows up to the
+    pattern length, or the `encode_rows()` entries (`width=72`) for
+    channels stored compressed (`--compress` and fewer bits than the
+    rows).
+    """
+    return crc32(b"".join(w.to_bytes(width//8, "little") for w in words))
+
 def sine_wave(init_phase=0, samples_n=128):
     vmax = 2**15-1 # 2**16-1
     samples = [int(vmax/2*(1+sin(i/samples_n*2*pi+init_phase)) ) for i in range(samples_n)]
@@ -1,15 +1,19 @@
 import argparse
+from functools import reduce
+from math import cos, sin, pi
+from operator import add, or_, xor
 
 from migen import *
 from phaser_impl import Platform
 from migen.genlib.io import DifferentialInput, DifferentialOutput
-from migen.genlib.cdc import MultiReg, AsyncResetSynchronizer
+from migen.genlib.cdc import MultiReg, AsyncResetSynchronizer, PulseSynchronizer
 from migen.genlib.fsm import *
-from memory_contents import memory_contents
+from migen.genlib.fifo import AsyncFIFO
+from memory_contents import memory_contents, encode_rows
 
 
 # increment this if the behavior (LEDs, registers, EEM pins) changes
-__proto_rev__ = 0
+__proto_rev__ = 1
 
 
 class AsyncRst(Module):
@@ -44,21 +48,1283 @@ ext_layout = [
     ("sdi", 1),
 ]
 
+trace_layout = [
+    ("cs", 1),
+    ("reg_we", 1),
+    ("dac_play", 1),
+    ("play", 1),
+    ("dac_istr", 1),
+    ("dac_oe", 1),
+    ("dac_test_pattern_en", 1),
+    ("dac_alarm", 1),
+    ("trf_ld", 2),
+    ("dac_cs", 1),
+    ("trf_cs", 2),
+    ("att_cs", 2),
+    ("sync", 1),
+]
+
 
 class REG(Module):
-    def __init__(self, width=None, read=True, write=True):
+    """Configuration register
+
+    With `batch`, writes while `batch` is set are held in a shadow and
+    only applied to `write` with `commit`. `discard` drops them. `pending`
+    flags a held write.
+    """
+    def __init__(self, width=None, read=True, write=True, reset=0, batch=False):
         self.bus = Record(bus_layout)
         if width is None:
             width = len(self.bus.dat_w)
         assert width <= len(self.bus.dat_w)
-        if write:
-            self.write = Signal(width)
+        if write and batch:
+            self.write = Signal(width, reset=reset)
+            self.batch = Signal()
+            self.commit = Signal()
+            self.discard = Signal()
+            self.pending = Signal()
+            shadow = Signal(width)
+            self.sync.reg += [
+                If(self.bus.we,
+                    If(self.batch,
+                        shadow.eq(self.bus.dat_w),
+                        self.pending.eq(1),
+                    ).Else(
+                        self.write.eq(self.bus.dat_w),
+                    )
+                ),
+                If(self.commit | self.discard,
+                    self.pending.eq(0),
+                ),
+                If(self.commit & self.pending,
+                    self.write.eq(shadow),
+                ),
+            ]
+        elif write:
+            self.write = Signal(width, reset=reset)
             self.sync.reg += If(self.bus.we, self.write.eq(self.bus.dat_w))
         if read:
             self.read = Signal(width)
             self.comb += self.bus.dat_r.eq(self.read)
 
 
+class CNT(Module):
+    """Event counters
+
+    `events` is a list of `(domain, signal)`, one counter per event. The
+    counters are free running and wrap. A write to the bus latches (bit 0)
+    and/or clears (bit 1) all counters. Within each clock domain this
+    happens on a single edge and no event is lost or counted twice.
+    Reads return the latched values, two 16 bit halves per counter
+    (LSB half at the even address). Allow a few cycles of the slowest
+    domain between the latch write and the readout.
+    """
+    def __init__(self, events, width=32):
+        self.bus = Record(bus_layout)
+
+        cmd = Signal(2)
+        self.sync.reg += If(self.bus.we, cmd.eq(self.bus.dat_w))
+
+        strobes = {"reg": (self.bus.we & self.bus.dat_w[0],
+                           self.bus.we & self.bus.dat_w[1])}
+        halves = []
+        for domain, event in events:
+            if domain not in strobes:
+                ps = PulseSynchronizer("reg", domain)
+                self.submodules += ps
+                self.comb += ps.i.eq(self.bus.we)
+                strobes[domain] = ps.o & cmd[0], ps.o & cmd[1]
+            latch, clear = strobes[domain]
+            cnt = Signal(width)
+            latched = Signal(width)
+            sync = getattr(self.sync, domain)
+            sync += [
+                If(clear,
+                    cnt.eq(event),
+                ).Else(
+                    cnt.eq(cnt + event),
+                ),
+                If(latch,
+                    latched.eq(cnt),
+                ),
+            ]
+            halves += [latched[i:i + 16] for i in range(0, width, 16)]
+
+        adr = self.bus.adr[:bits_for(len(halves) - 1)]
+        self.comb += Case(adr, dict(enumerate(
+            self.bus.dat_r.eq(h) for h in halves)))
+
+
+class IRQ(Module):
+    """Interrupt line
+
+    `events` is a list of `(domain, signal)` pulses, one cause bit each.
+    Events set their pending bit in the free running `cd` domain. `irq`
+    is high while any pending bit is unmasked. Reading CAUSE returns the
+    pending bits and clears exactly the bits returned; events that were
+    not yet visible stay pending. Repeated events of one kind until the
+    read are coalesced.
+
+    | ADR | Name  | Access | Function                            |
+    |-----+-------+--------+-------------------------------------|
+    | 0   | MASK  | RW     | Cause enable mask                   |
+    | 1   | CAUSE | R      | Pending causes, cleared on read     |
+    """
+    def __init__(self, events, cd="clk_gtp_div2"):
+        self.bus = Record(bus_layout)
+        self.irq = Signal()
+
+        n = len(events)
+        mask = Signal(n)
+        mask_cd = Signal(n)
+        pending = Signal(n)
+        pending_reg = Signal(n)
+        clear = Signal(n)
+        clear_t = Signal()
+        clear_t_cd = Signal()
+        clear_t_cd_r = Signal()
+        self.specials += [
+            MultiReg(mask, mask_cd, cd),
+            MultiReg(pending, pending_reg, "reg"),
+            MultiReg(clear_t, clear_t_cd, cd),
+        ]
+
+        # `clear` is stable for many `cd` cycles after the toggle
+        self.sync.reg += [
+            If(self.bus.we & (self.bus.adr[0] == 0),
+                mask.eq(self.bus.dat_w),
+            ),
+            If(self.bus.re & (self.bus.adr[0] == 1),
+                clear.eq(pending_reg),
+                clear_t.eq(~clear_t),
+            ),
+        ]
+        self.comb += Case(self.bus.adr[0], {
+            0: self.bus.dat_r.eq(mask),
+            1: self.bus.dat_r.eq(pending_reg),
+        })
+
+        sets = []
+        for domain, event in events:
+            if domain != cd:
+                ps = PulseSynchronizer(domain, cd)
+                self.submodules += ps
+                self.comb += ps.i.eq(event)
+                event = ps.o
+            sets.append(event)
+
+        sync = getattr(self.sync, cd)
+        sync += [
+            clear_t_cd_r.eq(clear_t_cd),
+            If(clear_t_cd != clear_t_cd_r,
+                pending.eq(pending & ~clear | Cat(*sets)),
+            ).Else(
+                pending.eq(pending | Cat(*sets)),
+            ),
+            self.irq.eq((pending & mask_cd) != 0),
+        ]
+
+
+class Trace(Module):
+    """Trace buffer
+
+    Records `sample` (up to 16 bits, `cd` domain) into a ring buffer of
+    `depth` entries in BRAM. An entry is written when the sample changes,
+    on a trigger, and when the timestamp would overflow. It holds the
+    sample (LSB half) and the number of `cd` cycles since the previous
+    entry minus one (MSB half).
+
+    Arming clears the buffer state and starts recording. The first
+    condition in `triggers` enabled by the trigger mask marks the trigger
+    entry and recording stops after `POST` further entries.
+
+    | ADR | Name  | Access | Function                            |
+    |-----+-------+--------+-------------------------------------|
+    | 0   | CTRL  | W      | ARM(0), trigger mask (1:)           |
+    |     | STAT  | R      | ARMED(0), TRIGD(1), DONE(2), WRAP(3)|
+    | 1   | POST  | RW     | Entries recorded after the trigger  |
+    | 2   | PTR   | R      | Next entry to be written            |
+    | 3   | ADR   | RW     | Readout address                     |
+    | 4   | SAMPLE| R      | Entry sample at ADR                 |
+    | 5   | DT    | R      | Entry timestamp at ADR, ADR += 1    |
+    | 6   | TRIG  | R      | Trigger entry                       |
+    | 7   | DEPTH | R      | Buffer depth                        |
+    """
+    def __init__(self, sample, triggers, depth=1024, cd="dac_clk"):
+        self.bus = Record(bus_layout)
+        assert len(sample) <= 16
+        assert depth < 1 << 16
+
+        mem = Memory(32, depth)
+        write_port = mem.get_port(write_capable=True, clock_domain=cd)
+        read_port = mem.get_port(clock_domain="reg")
+        self.specials += mem, write_port, read_port
+
+        mask = Signal(len(triggers))
+        post = Signal(max=depth)
+        adr = Signal(max=depth)
+        arm = PulseSynchronizer("reg", cd)
+        self.submodules += arm
+
+        bus_adr = self.bus.adr[:3]
+        self.sync.reg += [
+            If(self.bus.we,
+                Case(bus_adr, {
+                    0: mask.eq(self.bus.dat_w[1:]),
+                    1: post.eq(self.bus.dat_w),
+                    3: adr.eq(self.bus.dat_w),
+                }),
+            ).Elif(self.bus.re & (bus_adr == 5),
+                If(adr == depth - 1,
+                    adr.eq(0),
+                ).Else(
+                    adr.eq(adr + 1),
+                ),
+            ),
+        ]
+        self.comb += [
+            arm.i.eq(self.bus.we & (bus_adr == 0) & self.bus.dat_w[0]),
+            read_port.adr.eq(adr),
+        ]
+
+        armed = Signal()
+        triggered = Signal()
+        done = Signal()
+        wrapped = Signal()
+        ptr = Signal(max=depth)
+        trig_ptr = Signal(max=depth)
+        remaining = Signal(max=depth)
+        last = Signal(len(sample))
+        dt = Signal(16)
+        mask_cd = Signal(len(triggers))
+        post_cd = Signal(max=depth)
+        self.specials += [
+            MultiReg(mask, mask_cd, cd),
+            MultiReg(post, post_cd, cd),
+        ]
+
+        trigger = Signal()
+        store = Signal()
+        self.comb += [
+            trigger.eq(armed & ~triggered & (Cat(*triggers) & mask_cd != 0)),
+            store.eq(armed & ((sample != last) | (dt == 0xffff) | trigger)),
+            write_port.adr.eq(ptr),
+            write_port.dat_w[:16].eq(sample),
+            write_port.dat_w[16:].eq(dt),
+            write_port.we.eq(store),
+        ]
+        sync = getattr(self.sync, cd)
+        sync += [
+            last.eq(sample),
+            If(store,
+                dt.eq(0),
+                If(ptr == depth - 1,
+                    ptr.eq(0),
+                    wrapped.eq(1),
+                ).Else(
+                    ptr.eq(ptr + 1),
+                ),
+            ).Else(
+                dt.eq(dt + 1),
+            ),
+            If(trigger,
+                triggered.eq(1),
+                trig_ptr.eq(ptr),
+                remaining.eq(post_cd),
+                If(post_cd == 0,
+                    armed.eq(0),
+                    done.eq(1),
+                ),
+            ).Elif(store & triggered,
+                remaining.eq(remaining - 1),
+                If(remaining == 1,
+                    armed.eq(0),
+                    done.eq(1),
+                ),
+            ),
+            If(arm.o,
+                armed.eq(1),
+                triggered.eq(0),
+                done.eq(0),
+                wrapped.eq(0),
+                ptr.eq(0),
+                dt.eq(0),
+            ),
+        ]
+
+        self.comb += Case(bus_adr, {
+            0: self.bus.dat_r.eq(Cat(armed, triggered, done, wrapped)),
+            1: self.bus.dat_r.eq(post),
+            2: self.bus.dat_r.eq(ptr),
+            3: self.bus.dat_r.eq(adr),
+            4: self.bus.dat_r.eq(read_port.dat_r[:16]),
+            5: self.bus.dat_r.eq(read_port.dat_r[16:]),
+            6: self.bus.dat_r.eq(trig_ptr),
+            7: self.bus.dat_r.eq(depth),
+        })
+
+
+class ScaleOffset(Module):
+    """Sample scaling and offset
+
+    `o = saturate(((i*scale + 2**13) >> 14) + offset)` for each of the `n`
+    signed 16 bit samples in `i`. `scale` is signed Q2.14 (0x4000 is
+    unity), `offset` is signed. Multiplication and offset addition map to
+    a fully pipelined DSP48 per sample, saturation is registered after it.
+    """
+    latency = 4
+
+    def __init__(self, n=4, cd="dac_clk"):
+        self.i = Signal(16*n)
+        self.o = Signal(16*n)
+        self.scale = Signal((16, True))
+        self.offset = Signal((16, True))
+
+        sync = getattr(self.sync, cd)
+        for k in range(n):
+            a = Signal((16, True), reset_less=True)
+            b = Signal((16, True), reset_less=True)
+            c = Signal((16, True), reset_less=True)
+            c_m = Signal((16, True), reset_less=True)
+            m = Signal((32, True), reset_less=True)
+            p = Signal((33, True), reset_less=True)
+            y = Signal((19, True))
+            o = Signal((16, True), reset_less=True)
+            sync += [
+                a.eq(self.i[16*k:16*(k + 1)]),
+                b.eq(self.scale),
+                c.eq(self.offset),
+                m.eq(a*b),
+                c_m.eq(c),
+                p.eq(m + (c_m << 14) + (1 << 13)),
+                If(y > 0x7fff,
+                    o.eq(0x7fff),
+                ).Elif(y < -0x8000,
+                    o.eq(-0x8000),
+                ).Else(
+                    o.eq(y),
+                ),
+            ]
+            self.comb += [
+                y.eq(p >> 14),
+                self.o[16*k:16*(k + 1)].eq(o),
+            ]
+
+
+class Envelope(Module):
+    """Envelope generator
+
+    On `start` the envelope ramps from 0 to full scale with `rise`, holds
+    for `hold` cycles and ramps back to 0 with `fall`. The ramp phase is
+    a 20 bit accumulator advanced by the 16 bit `rise`/`fall` steps every
+    cycle (ramp time `2**20/step` cycles). `env` is unsigned Q2.14,
+    0x4000 at full scale, 1 cycle after the phase.
+
+    Linear mode outputs the ramp phase. Table mode looks up the upper 8
+    phase bits in a 256 entry table (the fall mirrors the rise). Table
+    entries are clamped to 0x4000. The table is written through
+    `table_adr_we` (sets the address) and `table_dat_we` (writes the
+    entry at the address and increments it) with `dat_w`.
+    """
+    latency = 1
+
+    def __init__(self, cd="dac_clk"):
+        self.start = Signal()
+        self.table = Signal()
+        self.rise = Signal(16)
+        self.hold = Signal(16)
+        self.fall = Signal(16)
+        self.env = Signal(15)
+
+        self.dat_w = Signal(16)
+        self.table_adr_we = Signal()
+        self.table_dat_we = Signal()
+
+        full = 1 << 20
+        phase = Signal(21)
+        hold = Signal(16)
+
+        sync = getattr(self.sync, cd)
+        fsm = ClockDomainsRenamer(cd)(FSM(reset_state="OFF"))
+        self.submodules += fsm
+
+        def act(state, *statements):
+            fsm.act(state,
+                If(self.start,
+                    NextValue(phase, 0),
+                    NextState("RISE"),
+                ).Else(
+                    *statements
+                )
+            )
+
+        act("OFF",
+            NextValue(phase, 0),
+        )
+        act("RISE",
+            If(phase + self.rise >= full,
+                NextValue(phase, full),
+                NextValue(hold, self.hold),
+                NextState("HOLD"),
+            ).Else(
+                NextValue(phase, phase + self.rise),
+            )
+        )
+        act("HOLD",
+            If(hold == 0,
+                NextState("FALL"),
+            ).Else(
+                NextValue(hold, hold - 1),
+            )
+        )
+        act("FALL",
+            If(phase <= self.fall,
+                NextValue(phase, 0),
+                NextState("OFF"),
+            ).Else(
+                NextValue(phase, phase - self.fall),
+            )
+        )
+
+        mem = Memory(15, 256)
+        write_port = mem.get_port(write_capable=True, clock_domain=cd)
+        read_port = mem.get_port(clock_domain=cd)
+        self.specials += mem, write_port, read_port
+
+        sync += [
+            If(self.table_adr_we,
+                write_port.adr.eq(self.dat_w),
+            ).Elif(self.table_dat_we,
+                write_port.adr.eq(write_port.adr + 1),
+            ),
+        ]
+        self.comb += [
+            write_port.we.eq(self.table_dat_we),
+            write_port.dat_w.eq(Mux(self.dat_w > 0x4000, 0x4000, self.dat_w)),
+            read_port.adr.eq(Mux(phase[20], 0xff, phase[12:20])),
+        ]
+
+        linear = Signal(15)
+        sync += linear.eq(phase[6:])
+        self.comb += self.env.eq(Mux(self.table, read_port.dat_r, linear))
+
+
+class DDS(Module):
+    """Table lookup DDS
+
+    Reads a stored pattern of `length` samples (4 per 64 bit row) at a
+    fractional rate. The phase is in samples with 16 fractional bits and
+    advances by `step` (unsigned, 2**-16 samples, below one sample) per
+    sample, i.e. `4*step` per cycle, wrapping at `length`. Output
+    frequency is `f_sample*step/(length*2**16)` for one stored period.
+
+    There is deliberately no integer part to `step`: the four samples of
+    a cycle and their right neighbors must lie in the two rows read per
+    cycle, which holds up to one sample per sample. The frequency is
+    thus below `f_sample/length` per stored period. Patterns with `n`
+    stored periods reach `n` times that.
+
+    The phase is held at 0 while `run` is low and restarts at 0 with
+    `start`. Every cycle the two rows covering the four samples and their
+    right neighbors are read from two memory ports (`adr`, `dat`, one
+    cycle read latency). With `interp`, the samples are linearly
+    interpolated between neighbors, otherwise the phase is truncated.
+    Interpolation is a pipelined DSP48 per sample with pre-adder.
+    `o` follows `dat` after `latency` cycles.
+    """
+    latency = 4
+
+    def __init__(self, length, channels=4, cd="dac_clk"):
+        depth = length//4
+        self.step = Signal(16)
+        self.interp = Signal()
+        self.start = Signal()
+        self.run = Signal()
+        self.adr = [Signal(max=depth), Signal(max=depth)]
+        self.dat = [[Signal(64), Signal(64)] for _ in range(channels)]
+        self.o = [Signal(64) for _ in range(channels)]
+
+        sync = getattr(self.sync, cd)
+
+        phase = Signal(bits_for(length) + 16)
+        phase_cur = Signal.like(phase)
+        phase_next = Signal(len(phase) + 1)
+        step4 = Signal(18, reset_less=True)
+        sync += step4.eq(self.step << 2)
+        self.comb += [
+            If(self.run & ~self.start,
+                phase_cur.eq(phase),
+            ),
+            phase_next.eq(phase_cur + step4),
+        ]
+        sync += [
+            If(self.run | self.start,
+                If(phase_next >= length << 16,
+                    phase.eq(phase_next - (length << 16)),
+                ).Else(
+                    phase.eq(phase_next),
+                ),
+            ).Else(
+                phase.eq(0),
+            ),
+        ]
+
+        row = phase_cur[18:]
+        self.comb += [
+            self.adr[0].eq(row),
+            self.adr[1].eq(Mux(row == depth - 1, 0, row + 1)),
+        ]
+
+        # per sample: position in the two rows, aligned with `dat`
+        steps = [Signal(18, reset_less=True) for k in range(4)]
+        pos = [Signal(19, reset_less=True) for k in range(4)]
+        interp = Signal(reset_less=True)
+        sync += interp.eq(self.interp)
+        for k in range(4):
+            sync += [
+                steps[k].eq(self.step*k),
+                pos[k].eq(phase_cur[:18] + steps[k]),
+            ]
+
+        for ch in range(channels):
+            window = Array(Cat(*self.dat[ch])[16*i:16*(i + 1)]
+                           for i in range(8))
+            for k in range(4):
+                s0 = Signal((16, True), reset_less=True)
+                s1 = Signal((16, True), reset_less=True)
+                f = Signal(17, reset_less=True)
+                s0_d = [Signal((16, True), reset_less=True) for _ in range(2)]
+                f_d = Signal((18, True), reset_less=True)
+                d = Signal((17, True), reset_less=True)
+                m = Signal((35, True), reset_less=True)
+                y = Signal((16, True), reset_less=True)
+                sync += [
+                    s0.eq(window[pos[k][16:]]),
+                    s1.eq(window[pos[k][16:] + 1]),
+                    f.eq(Mux(interp, pos[k][:16], 0)),
+                    d.eq(s1 - s0),
+                    s0_d[0].eq(s0),
+                    f_d.eq(f),
+                    m.eq(d*f_d),
+                    s0_d[1].eq(s0_d[0]),
+                    y.eq(s0_d[1] + ((m + (1 << 15)) >> 16)),
+                ]
+                self.comb += self.o[ch][16*k:16*(k + 1)].eq(y)
+
+
+class IQMixer(Module):
+    """Complex mixer with NCO
+
+    Each pair of channels in `i` (I, Q) is multiplied by `exp(j*phi)`,
+    `o = saturate(((I*cos - Q*sin) >> 15, (I*sin + Q*cos) >> 15))`, four
+    samples per cycle. The NCO phase advances by `ftw` (2**-32 turns) per
+    sample and is offset by `pow` (2**-16 turns). It is reset with
+    `start` such that the samples arriving 2 cycles later see the phase
+    `pow`. sin/cos come from a 1024 entry table in two dual port BRAMs
+    (phase truncated to 10 bits). The multiplications and sums map to
+    four pipelined DSP48 per sample. `o` follows `i` after `latency`
+    cycles.
+    """
+    latency = 4
+
+    def __init__(self, pairs=2, cd="dac_clk"):
+        self.i = [(Signal(64), Signal(64)) for _ in range(pairs)]
+        self.o = [(Signal(64), Signal(64)) for _ in range(pairs)]
+        self.ftw = Signal(32)
+        self.pow = Signal(16)
+        self.start = Signal()
+
+        sync = getattr(self.sync, cd)
+
+        phase = Signal(32)
+        phase_cur = Signal(32)
+        steps = [Signal(32, reset_less=True) for k in range(5)]
+        for k in range(5):
+            sync += steps[k].eq(self.ftw*k)
+        self.comb += If(~self.start, phase_cur.eq(phase))
+        sync += phase.eq(phase_cur + steps[4])
+
+        table = [int(round(0x7fff*cos(2*pi*k/1024))) & 0xffff |
+                 (int(round(0x7fff*sin(2*pi*k/1024))) & 0xffff) << 16
+                 for k in range(1024)]
+        cs = []
+        for k in range(0, 4, 2):
+            mem = Memory(32, 1024, init=table)
+            ports = [mem.get_port(clock_domain=cd) for _ in range(2)]
+            self.specials += mem, ports
+            for j, port in enumerate(ports):
+                lane = Signal(32, reset_less=True)
+                sync += lane.eq(phase_cur + steps[k + j] + (self.pow << 16))
+                self.comb += port.adr.eq(lane[22:])
+                cs.append(port.dat_r)
+
+        for (i, q), (oi, oq) in zip(self.i, self.o):
+            for k in range(4):
+                c = Signal((16, True), reset_less=True)
+                s = Signal((16, True), reset_less=True)
+                a_i = Signal((16, True), reset_less=True)
+                a_q = Signal((16, True), reset_less=True)
+                m = [Signal((32, True), reset_less=True) for _ in range(4)]
+                p_i = Signal((33, True), reset_less=True)
+                p_q = Signal((33, True), reset_less=True)
+                y_i = Signal((18, True))
+                y_q = Signal((18, True))
+                r_i = Signal((16, True), reset_less=True)
+                r_q = Signal((16, True), reset_less=True)
+                sync += [
+                    c.eq(cs[k][:16]),
+                    s.eq(cs[k][16:]),
+                    a_i.eq(i[16*k:16*(k + 1)]),
+                    a_q.eq(q[16*k:16*(k + 1)]),
+                    m[0].eq(a_i*c),
+                    m[1].eq(a_q*s),
+                    m[2].eq(a_i*s),
+                    m[3].eq(a_q*c),
+                    p_i.eq(m[0] - m[1] + (1 << 14)),
+                    p_q.eq(m[2] + m[3] + (1 << 14)),
+                ]
+                self.comb += [
+                    y_i.eq(p_i >> 15),
+                    y_q.eq(p_q >> 15),
+                ]
+                for y, r in ((y_i, r_i), (y_q, r_q)):
+                    sync += [
+                        If(y > 0x7fff,
+                            r.eq(0x7fff),
+                        ).Elif(y < -0x8000,
+                            r.eq(-0x8000),
+                        ).Else(
+                            r.eq(y),
+                        ),
+                    ]
+                self.comb += [
+                    oi[16*k:16*(k + 1)].eq(r_i),
+                    oq[16*k:16*(k + 1)].eq(r_q),
+                ]
+
+
+def interpolation_taps(rate, taps=6):
+    """Polyphase interpolation filter coefficients
+
+    Blackman windowed sinc lowpass at the input Nyquist frequency,
+    `rate*taps` taps, signed Q2.16. `h[p + rate*k]` is tap `k` of phase
+    `p`. Each phase sums to exactly 1 (flat DC response) and phase 0 is
+    a pure delay of `taps//2` input samples, so stored samples are
+    reproduced exactly.
+    """
+    n = rate*taps
+    h = []
+    for i in range(n):
+        t = (i - n//2)/rate
+        sinc = sin(pi*t)/(pi*t) if t else 1.
+        window = 0.42 - 0.5*cos(2*pi*i/n) + 0.08*cos(4*pi*i/n)
+        h.append(int(round(sinc*window*(1 << 16))))
+    for p in range(rate):
+        k = max(range(taps), key=lambda k: abs(h[p + rate*k]))
+        h[p + rate*k] += (1 << 16) - sum(h[p::rate])
+    return h
+
+
+class Interpolator(Module):
+    """Polyphase interpolation filter
+
+    Plays each 64 bit row at `i` (four signed 16 bit samples) over `rate`
+    (2, 4, 8) cycles, four output samples per cycle at `o`:
+    `y[rate*n + p] = saturate((sum(h[p + rate*k]*x[n - k]) + 2**15) >> 16)`
+    with the coefficients `h` from `interpolation_taps()`. The first row
+    must be at `i` 2 cycles after `start` and held for `rate` cycles, the
+    next ones follow every `rate` cycles. `start` clears the sample
+    history. Each output sample maps to `taps` pipelined DSP48 multiplies
+    and a registered adder tree. An output row follows the row it is
+    computed from after `latency` cycles.
+    """
+    latency = 5
+
+    def __init__(self, rate, taps=6, cd="dac_clk"):
+        assert rate in (2, 4, 8)
+        self.i = Signal(64)
+        self.o = Signal(64)
+        self.start = Signal()
+
+        sync = getattr(self.sync, cd)
+        h = interpolation_taps(rate, taps)
+        # new input samples per cycle, or one every other cycle
+        n = max(4//rate, 1)
+
+        start = Signal()
+        cnt = Signal(max=rate)
+        par = Signal()
+        sync += [
+            start.eq(self.start),
+            cnt.eq(cnt + 1),
+            If(self.start,
+                cnt.eq(rate - 1),
+            ),
+            par.eq(cnt[0]),
+        ]
+
+        x = Array(self.i[16*k:16*(k + 1)] for k in range(4))
+        win = [Signal((16, True), reset_less=True) for _ in range(taps + n - 1)]
+        shift = Signal()
+        self.comb += shift.eq(1 if rate < 8 else ~cnt[0])
+        sync += If(start,
+            [w.eq(0) for w in win],
+        ).Elif(shift,
+            [w.eq(win[j - n]) for j, w in enumerate(win) if j >= n],
+            [win[n - 1 - j].eq(x[cnt*n + j if rate < 8 else cnt >> 1])
+             for j in range(n)],
+        )
+
+        for s in range(4):
+            m = [Signal((34, True), reset_less=True) for _ in range(taps)]
+            acc = Signal((34 + bits_for(taps), True), reset_less=True)
+            y = Signal((18 + bits_for(taps), True))
+            r = Signal((16, True), reset_less=True)
+            for k in range(taps):
+                if rate < 8:
+                    a = win[n - 1 - s//rate + k]
+                    sync += m[k].eq(a*Constant(h[s % rate + rate*k], (18, True)))
+                else:
+                    sync += m[k].eq(win[k]*Mux(par,
+                        Constant(h[4 + s + rate*k], (18, True)),
+                        Constant(h[s + rate*k], (18, True))))
+            pairs = [Signal((35, True), reset_less=True)
+                     for _ in range((taps + 1)//2)]
+            sync += [
+                [pair.eq(reduce(add, m[2*j:2*j + 2]))
+                 for j, pair in enumerate(pairs)],
+                acc.eq(reduce(add, pairs) + (1 << 15)),
+                If(y > 0x7fff,
+                    r.eq(0x7fff),
+                ).Elif(y < -0x8000,
+                    r.eq(-0x8000),
+                ).Else(
+                    r.eq(y),
+                ),
+            ]
+            self.comb += [
+                y.eq(acc >> 16),
+                self.o[16*s:16*(s + 1)].eq(r),
+            ]
+
+
+class RowDecoder(Module):
+    """Compressed pattern decoder
+
+    Expands `encode_rows()` entries (see `memory_contents`) to one 64 bit
+    row per cycle at `o`. The read port always presents the current entry
+    and the next address is decoded from it, so runs of any length down to
+    one row stream without stalls. The decoder is held at the first row
+    while `run` is low and restarts there with `start`; `o` is the row 2
+    cycles later (as for the plain BRAM with its output register). The
+    first entry must be a row. `read_adr`/`read_dat` is a second read port
+    on the entries.
+    """
+    def __init__(self, entries, cd="dac_clk"):
+        self.start = Signal()
+        self.run = Signal()
+        self.o = Signal(64)
+
+        # migen needs two words at least
+        depth = max(len(entries), 2)
+        mem = Memory(72, depth, init=entries)
+        port = mem.get_port(clock_domain=cd)
+        read_port = mem.get_port(clock_domain=cd)
+        self.specials += mem, port, read_port
+        self.read_adr = read_port.adr
+        self.read_dat = read_port.dat_r
+
+        ptr = Signal(max=depth)
+        ptr_next = Signal.like(ptr)
+        rep = Signal(7)
+        rep_next = Signal.like(rep)
+        n = port.dat_r[64:71]
+        delta = port.dat_r[71]
+
+        self.comb += [
+            ptr_next.eq(ptr),
+            rep_next.eq(rep + 1),
+            If(self.start | ~self.run,
+                ptr_next.eq(0),
+                rep_next.eq(0),
+            ).Elif(rep == n,
+                rep_next.eq(0),
+                If(ptr != len(entries) - 1,
+                    ptr_next.eq(ptr + 1),
+                ).Else(
+                    ptr_next.eq(0),
+                ),
+            ),
+            port.adr.eq(ptr_next),
+        ]
+        sync = getattr(self.sync, cd)
+        sync += [
+            ptr.eq(ptr_next),
+            rep.eq(rep_next),
+        ]
+        for k in range(4):
+            lane = slice(16*k, 16*(k + 1))
+            sync += [
+                If(delta,
+                    self.o[lane].eq(self.o[lane] + port.dat_r[lane]),
+                ).Else(
+                    self.o[lane].eq(port.dat_r[lane]),
+                ),
+            ]
+
+
+def _crc32_columns(width, poly=0xedb88320):
+    """Effect of each state and data bit on the reflected CRC-32 after
+    shifting in `width` data bits LSB first."""
+    def step(crc, data):
+        for i in range(width):
+            crc = (crc >> 1) ^ (poly if (crc ^ (data >> i)) & 1 else 0)
+        return crc
+    return ([step(1 << j, 0) for j in range(32)],
+            [step(0, 1 << j) for j in range(width)])
+
+
+class PatternCRC(Module):
+    """Pattern memory CRC
+
+    On START, reads the `depth` words of each of the memories (`width`,
+    `depth` in `memories`) through `adr`/`dat` (one cycle read latency)
+    in the `cd` domain, one word per cycle, and computes their CRC-32
+    (as `zlib.crc32()` over the words as little endian bytes, see
+    `pattern_crc()` in `memory_contents`).
+
+    | ADR   | Name  | Access | Function                               |
+    |-------+-------+--------+----------------------------------------|
+    | 0     | CTRL  | W      | START (0)                              |
+    |       | STAT  | R      | BUSY (0)                               |
+    | 2+2*i | CRC_LO| R      | Memory i CRC, LSB half (valid if idle) |
+    | 3+2*i | CRC_HI| R      | Memory i CRC, MSB half                 |
+
+    `reading` is high in the cycles in which `adr` drives a read, from
+    the START cycle on (`busy` follows one cycle later).
+    """
+    def __init__(self, memories, cd="dac_clk"):
+        self.bus = Record(bus_layout)
+        self.busy = Signal()
+        self.reading = Signal()
+        self.adr = [Signal(max=max(depth, 2)) for width, depth in memories]
+        self.dat = [Signal(width) for width, depth in memories]
+
+        # START toggles `start_reg`, the end of the sweep copies it into
+        # `done`: BUSY is set from the START write on
+        start_reg = Signal()
+        start_cd = Signal()
+        start_cd_r = Signal()
+        start = Signal()
+        done = Signal()
+        done_reg = Signal()
+        self.sync.reg += If(self.bus.we & (self.bus.adr[:4] == 0) &
+                            self.bus.dat_w[0],
+            start_reg.eq(~start_reg),
+        )
+        self.specials += [
+            MultiReg(start_reg, start_cd, cd),
+            MultiReg(done, done_reg, "reg"),
+        ]
+
+        sync = getattr(self.sync, cd)
+        sync += start_cd_r.eq(start_cd)
+        self.comb += start.eq(start_cd != start_cd_r)
+        busy = []
+        reading = [start]
+        results = []
+        for (width, depth), adr, dat in zip(memories, self.adr, self.dat):
+            running = Signal()
+            valid = Signal()
+            crc = Signal(32, reset=0xffffffff)
+            sync += [
+                valid.eq(running),
+                If(start,
+                    running.eq(1),
+                    adr.eq(0),
+                    crc.eq(0xffffffff),
+                ).Elif(running,
+                    adr.eq(adr + 1),
+                    If(adr == depth - 1,
+                        running.eq(0),
+                    ),
+                ),
+            ]
+            state_cols, data_cols = _crc32_columns(width)
+            next_crc = []
+            for k in range(32):
+                terms = [crc[j] for j in range(32) if state_cols[j] >> k & 1]
+                terms += [dat[j] for j in range(width) if data_cols[j] >> k & 1]
+                next_crc.append(reduce(xor, terms))
+            sync += If(valid, crc.eq(Cat(*next_crc)))
+            busy += [running, valid]
+            reading.append(running)
+
+            result = Signal(32)
+            self.specials += MultiReg(~crc, result, "reg")
+            results.append(result)
+        self.comb += self.reading.eq(reduce(or_, reading))
+        sync += [
+            self.busy.eq(reduce(or_, busy)),
+            If(self.busy & ~reduce(or_, busy),
+                done.eq(start_cd_r),
+            ),
+        ]
+
+        cases = {0: self.bus.dat_r.eq(start_reg != done_reg)}
+        for i, result in enumerate(results):
+            cases[2 + 2*i] = self.bus.dat_r.eq(result[:16])
+            cases[3 + 2*i] = self.bus.dat_r.eq(result[16:])
+        self.comb += Case(self.bus.adr[:4], cases)
+
+
+# ITU-T O.150 PRBS polynomials: order, (n, m) taps of x**n + x**m + 1
+PRBS_TAPS = {7: (7, 6), 15: (15, 14), 31: (31, 28)}
+
+
+class PRBS(Module):
+    """PRBS lane generators
+
+    One LFSR per lane, `n` bits per cycle each (first bit at the LSB).
+    `mode` selects PRBS7 (1), PRBS15 (2) or PRBS31 (3), the output is 0
+    otherwise. The sequence is the non-inverted ITU-T O.150 one, each
+    lane starts from its own seed (`PRBS.seed()`, nonzero in the low
+    `order` bits for every order).
+    """
+    orders = [7, 15, 31]
+
+    @staticmethod
+    def seed(lane, order=31):
+        """Nonzero `order` bit start state of `lane`."""
+        return (0x5eed + 0x9e3779b1*(lane + 1)) % ((1 << order) - 1) + 1
+
+    def __init__(self, lanes, n=8, cd="dac_clk"):
+        self.mode = Signal(2)
+        self.o = [Signal(n) for _ in range(lanes)]
+
+        sync = getattr(self.sync, cd)
+        for lane, o in enumerate(self.o):
+            # nonzero low 7 bits: nonzero for all orders
+            state = Signal(31, reset=self.seed(lane) & ~0x7f | self.seed(lane, 7))
+            bits = {}
+            for order in self.orders:
+                t0, t1 = PRBS_TAPS[order]
+                s = [state[i] for i in range(order)]
+                out = []
+                for _ in range(n):
+                    new = s[t0 - 1] ^ s[t1 - 1]
+                    s = [new] + s[:-1]
+                    out.append(new)
+                bits[order] = Cat(*out), Cat(*s)
+            cases = {}
+            for i, order in enumerate(self.orders):
+                out, s = bits[order]
+                cases[i + 1] = [
+                    o.eq(out),
+                    state[:order].eq(s),
+                    # keep a short register out of the all zero state
+                    If(state[:order] == 0, state[:order].eq(self.seed(lane, order))),
+                ]
+            cases["default"] = o.eq(0)
+            sync += Case(self.mode, cases)
+
+
+class TimedQueue(Module):
+    """Timed command queue
+
+    Commands `(time, adr, dat)` are written over SPI into a FIFO. In the
+    `cd` domain a free running cycle counter `now` advances every cycle.
+    The command at the head of the queue is issued on `out` (`we`, `adr`,
+    `dat_w`) in the cycle in which `now == time`. A command with IMM set
+    is issued as soon as it reaches the head. A command whose time has
+    passed (more than 2**31 cycles ago counts as in the future) is issued
+    at once and sets LATE.
+
+    | ADR | Name    | Access | Function                               |
+    |-----+---------+--------+----------------------------------------|
+    | 0   | CTRL    | W      | Clear LATE/OVF (0), latch `now` (1)    |
+    |     | STAT    | R      | LATE(0), OVF(1), EMPTY(2)              |
+    | 1   | TIME_LO | W      | Command time, LSB half                 |
+    |     |         | R      | Latched `now`, LSB half                |
+    | 2   | TIME_HI | W      | Command time, MSB half                 |
+    |     |         | R      | Latched `now`, MSB half                |
+    | 3   | ADR     | W      | Command address (0:7), IMM (15)        |
+    | 4   | DAT     | W      | Command data, enqueues the command     |
+
+    TIME and ADR are kept, so commands to the same target only need
+    the DAT write (or DAT and TIME_LO). One command is issued per cycle,
+    commands for the same time issue on consecutive cycles and set LATE.
+    OVF is set if a command is written while the queue is full, the
+    command is dropped.
+    """
+    def __init__(self, depth=32, cd="dac_clk", cd_fifo=None):
+        self.bus = Record(bus_layout)
+        self.out = Record(bus_layout)
+        self.now = Signal(32)
+
+        time = Signal(32)
+        adr = Signal(len(self.out.adr))
+        imm = Signal()
+        late = Signal()
+        ovf = Signal()
+        now_latched = Signal(32)
+
+        layout = [("time", 32), ("adr", len(adr)), ("imm", 1), ("dat", 16)]
+        fifo = ClockDomainsRenamer({"write": "reg", "read": cd_fifo or cd})(
+            AsyncFIFO(layout_len(layout), depth))
+        self.submodules += fifo
+        din = Record(layout)
+        dout = Record(layout)
+        self.comb += [
+            fifo.din.eq(din.raw_bits()),
+            dout.raw_bits().eq(fifo.dout),
+        ]
+
+        bus_adr = self.bus.adr[:3]
+        clear = PulseSynchronizer("reg", cd)
+        latch = PulseSynchronizer("reg", cd)
+        self.submodules += clear, latch
+        self.comb += [
+            clear.i.eq(self.bus.we & (bus_adr == 0) & self.bus.dat_w[0]),
+            latch.i.eq(self.bus.we & (bus_adr == 0) & self.bus.dat_w[1]),
+            din.time.eq(time),
+            din.adr.eq(adr),
+            din.imm.eq(imm),
+            din.dat.eq(self.bus.dat_w),
+            fifo.we.eq(self.bus.we & (bus_adr == 4)),
+        ]
+        self.sync.reg += [
+            If(clear.i,
+                ovf.eq(0),
+            ),
+            If(fifo.we & ~fifo.writable,
+                ovf.eq(1),
+            ),
+            If(self.bus.we,
+                Case(bus_adr, {
+                    1: time[:16].eq(self.bus.dat_w),
+                    2: time[16:].eq(self.bus.dat_w),
+                    3: [
+                        adr.eq(self.bus.dat_w),
+                        imm.eq(self.bus.dat_w[15]),
+                    ],
+                }),
+            ),
+        ]
+
+        issue = Signal()
+        due = Signal(32)
+        self.comb += [
+            due.eq(dout.time - self.now),
+            issue.eq(fifo.readable & (dout.imm | (due == 0) | due[-1])),
+            fifo.re.eq(issue),
+            self.out.we.eq(issue),
+            self.out.adr.eq(dout.adr),
+            self.out.dat_w.eq(dout.dat),
+        ]
+        sync = getattr(self.sync, cd)
+        sync += [
+            self.now.eq(self.now + 1),
+            If(latch.o,
+                now_latched.eq(self.now),
+            ),
+            If(clear.o,
+                late.eq(0),
+            ),
+            If(issue & ~dout.imm & due[-1],
+                late.eq(1),
+            ),
+        ]
+
+        self.comb += Case(bus_adr, {
+            0: self.bus.dat_r.eq(Cat(late, ovf, ~fifo.readable)),
+            1: self.bus.dat_r.eq(now_latched[:16]),
+            2: self.bus.dat_r.eq(now_latched[16:]),
+        })
+
+
+class SPISeq(Module):
+    """SPI sequencer
+
+    Plays lists of preloaded SPI words to the `devices` buses in `ext`
+    (`cs` active high, `sdi` MSB first, changing on the falling `sck`
+    edge). Entries are written over SPI into a `depth` entry table. A
+    sequence starts at entry START and runs up to and including the
+    first entry with END set. It is fired by FIRE, by `trig` (a single
+    cycle pulse) with TRIG_EN set, or by `fire` with `fire_adr` as the
+    first entry. Fires while
+    BUSY are ignored. `sck` runs at the `cd` clock divided by
+    `2*(DIV + 1)`, `cs` is deasserted for `DIV + 1` cycles between
+    words. `busy` is high from the first to the last `ext` change and
+    selects the sequencer on the device pins.
+
+    | ADR | Name   | Access | Function                                 |
+    |-----+--------+--------+------------------------------------------|
+    | 0   | CTRL   | W      | FIRE (0), ABORT (1)                      |
+    |     | STAT   | R      | BUSY (0)                                 |
+    | 1   | START  | RW     | First entry (0:8), TRIG_EN (15)          |
+    | 2   | DIV    | RW     | SCK half period - 1 in `cd` cycles (0:8) |
+    | 3   | WADR   | W      | Table write address (0:8)                |
+    | 4   | WDAT0  | W      | Entry word, LSB half                     |
+    | 5   | WDAT1  | W      | Entry word, MSB half                     |
+    | 6   | WDAT2  | W      | Entry LEN - 1 (0:5), DEV (5:7), END (7), |
+    |     |        |        | writes the entry and increments WADR     |
+
+    The entry shifts out the upper LEN bits of its 32 bit word to device
+    DEV.
+    """
+    def __init__(self, depth=256, devices=4, cd="dac_clk"):
+        self.bus = Record(bus_layout)
+        self.ext = [Record(ext_layout) for _ in range(devices)]
+        self.trig = Signal()
+        self.fire = Signal()
+        self.fire_adr = Signal(max=depth)
+        self.busy = Signal()
+
+        layout = [("dat", 32), ("len", 5), ("dev", 2), ("end", 1)]
+        mem = Memory(layout_len(layout), depth)
+        write_port = mem.get_port(write_capable=True, clock_domain="reg")
+        read_port = mem.get_port(clock_domain=cd)
+        self.specials += mem, write_port, read_port
+
+        start = Signal(max=depth)
+        trig_en = Signal()
+        div = Signal(8, reset=1)
+        wdat = Signal(32)
+        entry = Record(layout)
+
+        bus_adr = self.bus.adr[:3]
+        fire = PulseSynchronizer("reg", cd)
+        abort = PulseSynchronizer("reg", cd)
+        self.submodules += fire, abort
+        self.comb += [
+            fire.i.eq(self.bus.we & (bus_adr == 0) & self.bus.dat_w[0]),
+            abort.i.eq(self.bus.we & (bus_adr == 0) & self.bus.dat_w[1]),
+            entry.dat.eq(wdat),
+            entry.raw_bits()[32:].eq(self.bus.dat_w),
+            write_port.dat_w.eq(entry.raw_bits()),
+            write_port.we.eq(self.bus.we & (bus_adr == 6)),
+        ]
+        self.sync.reg += [
+            If(self.bus.we,
+                Case(bus_adr, {
+                    1: [
+                        start.eq(self.bus.dat_w),
+                        trig_en.eq(self.bus.dat_w[15]),
+                    ],
+                    2: div.eq(self.bus.dat_w),
+                    3: write_port.adr.eq(self.bus.dat_w),
+                    4: wdat[:16].eq(self.bus.dat_w),
+                    5: wdat[16:].eq(self.bus.dat_w),
+                    6: write_port.adr.eq(write_port.adr + 1),
+                }),
+            ),
+        ]
+
+        start_cd = Signal.like(start)
+        trig_en_cd = Signal()
+        div_cd = Signal.like(div)
+        busy_reg = Signal()
+        self.specials += [
+            MultiReg(start, start_cd, cd),
+            MultiReg(trig_en, trig_en_cd, cd),
+            MultiReg(div, div_cd, cd),
+            MultiReg(self.busy, busy_reg, "reg"),
+        ]
+        self.comb += Case(bus_adr, {
+            0: self.bus.dat_r.eq(busy_reg),
+            1: self.bus.dat_r.eq(Cat(start, Constant(0, 15 - len(start)), trig_en)),
+            2: self.bus.dat_r.eq(div),
+        })
+
+        adr = Signal(max=depth)
+        word = Record(layout)
+        current = Record(layout)
+        count = Signal(8)
+        cs = Signal()
+        sck = Signal()
+        self.comb += [
+            read_port.adr.eq(adr),
+            current.raw_bits().eq(read_port.dat_r),
+        ]
+
+        fsm = ClockDomainsRenamer(cd)(FSM(reset_state="IDLE"))
+        self.submodules += fsm
+
+        def act(state, *statements):
+            fsm.act(state,
+                If(abort.o,
+                    NextState("IDLE"),
+                ).Else(
+                    *statements
+                )
+            )
+
+        act("IDLE",
+            If(self.fire,
+                NextValue(adr, self.fire_adr),
+                NextState("FETCH"),
+            ).Elif(fire.o | (trig_en_cd & self.trig),
+                NextValue(adr, start_cd),
+                NextState("FETCH"),
+            )
+        )
+        act("FETCH",
+            NextState("LOAD"),
+        )
+        act("LOAD",
+            NextValue(word.dat, current.dat),
+            NextValue(word.len, current.len),
+            NextValue(word.dev, current.dev),
+            NextValue(word.end, current.end),
+            NextValue(count, div_cd),
+            NextState("LOW"),
+        )
+        act("LOW",
+            cs.eq(1),
+            NextValue(count, count - 1),
+            If(count == 0,
+                NextValue(count, div_cd),
+                NextState("HIGH"),
+            )
+        )
+        act("HIGH",
+            cs.eq(1),
+            sck.eq(1),
+            NextValue(count, count - 1),
+            If(count == 0,
+                NextValue(count, div_cd),
+                NextValue(word.dat, word.dat << 1),
+                NextValue(word.len, word.len - 1),
+                If(word.len == 0,
+                    NextState("GAP"),
+                ).Else(
+                    NextState("LOW"),
+                )
+            )
+        )
+        act("GAP",
+            NextValue(count, count - 1),
+            If(count == 0,
+                If(word.end,
+                    NextState("IDLE"),
+                ).Else(
+                    NextValue(adr, adr + 1),
+                    NextState("FETCH"),
+                )
+            )
+        )
+
+        sync = getattr(self.sync, cd)
+        sync += self.busy.eq(~fsm.ongoing("IDLE"))
+        for i, ext in enumerate(self.ext):
+            sync += [
+                ext.cs.eq(cs & (word.dev == i)),
+                ext.sck.eq(sck & (word.dev == i)),
+                ext.sdi.eq(word.dat[-1] & cs & (word.dev == i)),
+            ]
+
+
 # R,F edges happen left in each column
 
 # CSN  -F__________R
@@ -163,8 +1429,55 @@ class SR(Module):
 
 def intersection(a, b):
     (aa, am), (ba, bm) = a, b
-    # TODO
-    return False
+    return (aa ^ ba) & am & bm == 0
+
+
+# XC7A100T-3, DS181
+PLL_F_PFD = (19e6, 550e6)
+PLL_F_VCO = (800e6, 2133e6)
+PLL_F_OUT_MAX = 800e6
+PLL_MULT = range(2, 65)
+PLL_DIVCLK = range(1, 57)
+PLL_DIVIDE_MAX = 128
+OSERDES_RATE_MAX = 1250e6  # DDR, per lane
+
+
+def solve_pll(f_in, f_sample):
+    """PLLE2 settings for a DAC sample rate `f_sample` from `f_in`.
+
+    The OSERDESE2 run 8:1 DDR with CLK at the sample rate (two channels
+    interleaved per lane) and CLKDIV at a quarter of it. Returns a dict
+    with DIVCLK_DIVIDE, CLKFBOUT_MULT, the CLK and CLKDIV output dividers
+    and the resulting VCO and output frequencies. Prefers the highest VCO
+    frequency. Raises ValueError if the lane rate exceeds the OSERDES
+    limit or the rate can not be reached exactly.
+    """
+    if 2*f_sample > OSERDES_RATE_MAX:
+        raise ValueError("lane rate {:g} Mb/s exceeds OSERDES limit {:g} Mb/s".format(
+            2*f_sample/1e6, OSERDES_RATE_MAX/1e6))
+    if f_sample > PLL_F_OUT_MAX:
+        raise ValueError("sample rate {:g} MHz exceeds PLL output limit".format(
+            f_sample/1e6))
+    best = None
+    for d in PLL_DIVCLK:
+        f_pfd = f_in/d
+        if not PLL_F_PFD[0] <= f_pfd <= PLL_F_PFD[1]:
+            continue
+        for m in PLL_MULT:
+            f_vco = f_pfd*m
+            if not PLL_F_VCO[0] <= f_vco <= PLL_F_VCO[1]:
+                continue
+            o = round(f_vco/f_sample)
+            if not 1 <= o <= PLL_DIVIDE_MAX//4 or abs(f_vco/o - f_sample) > 1e-6*f_sample:
+                continue
+            if best is None or f_vco > best["f_vco"]:
+                best = dict(DIVCLK_DIVIDE=d, CLKFBOUT_MULT=m,
+                            DIVIDE_4X=o, DIVIDE=4*o,
+                            f_vco=f_vco, f_4x=f_vco/o, f=f_vco/(4*o))
+    if best is None:
+        raise ValueError("no PLL settings for {:g} MHz from {:g} MHz".format(
+            f_sample/1e6, f_in/1e6))
+    return best
 
 
 class Phaser(Module):
@@ -181,6 +1494,9 @@ class Phaser(Module):
     | EEM 1         | MOSI                   |
     | EEM 2         | MISO                   |
     | EEM 3         | CS                     |
+    | EEM 4         | SYNC (input)           |
+    | EEM 5         | TRIG (input)           |
+    | EEM 6         | IRQ (output)           |
 
     SPI
     ---
@@ -195,10 +1511,18 @@ class Phaser(Module):
     | 3   | REG3   |
     | 4   | REG4   |
     | 5   | DAC    |
-    | 6   | MOD0   |
-    | 7   | MOD1   |
+    | 6   | TRF0   |
+    | 7   | TRF1   |
     | 8   | ATT0   |
     | 9   | ATT1   |
+    | 10  | STAT   |
+    | 11  | BATCH  |
+    | 12-13 | IRQ  |
+    | 16-23 | TQ   |
+    | 32-63 | CNT  |
+    | 64-71 | TRC  |
+    | 72-79 | SEQ  |
+    | 80-95 | CRC  |
 
     The SPI interface is CPOL=0, CPHA=0, SPI mode 0, 4-wire, full fuplex.
 
@@ -233,6 +1557,14 @@ class Phaser(Module):
 
     | Name      | Width | Function                           |
     |-----------+-------+------------------------------------|
+    | DAC_PRBS  | 2     | Lane PRBS instead of samples:      | 10:12
+    |           |       | 00: off                            |
+    |           |       | 01: PRBS7                          |
+    |           |       | 10: PRBS15                         |
+    |           |       | 11: PRBS31                         |
+    | TRIG_STOP | 1     | Stop playback on TRIG              |  9
+    | TRIG_START| 1     | Start/restart playback on TRIG     |  8
+    | DAC_SYNCen| 1     | Start playback on SYNC             |  7
     | DAC_TESTen| 1     | DAC test pattern enabled           |  6
     | DAC_IFRSTn| 1     | DAC interface reset, active low    |  5
     | DAC_PLAY  | 1     | Play samples embedded in BRAM      |  4
@@ -241,6 +1573,66 @@ class Phaser(Module):
     | DAC_SLEEP | 1     | DAC sleep, active high             |  1
     | DAC_TXENA | 1     | DAC TX Enabled, active high        |  0
 
+    DAC_PRBS replaces the data on each of the 32 LVDS data lanes with its
+    own PRBS (see `PRBS`, ITU-T O.150 polynomials, 8 bits per `dac_clk`
+    cycle and lane, before the HW #102 lane inversions so that the pins
+    carry the true sequence). It takes precedence over DAC_TESTen. The
+    DAC has no PRBS checker; capture a lane and check it with
+    `prbs_check.py`.
+
+    The data path from the pattern memory read to the OSERDES inputs
+    (BRAM output register, envelope alignment, scale/offset, test pattern
+    mux) has a latency of 7 `dac_clk` cycles, plus 4 if built with the
+    DDS and plus 5 with the IQ mixer. DAC_ISTR and DAC SYNC are delayed
+    to match.
+
+    Built with `--compress`, the patterns are stored run length and delta
+    encoded (`encode_rows()` in `memory_contents`, 72 bit entries) and
+    expanded by a `RowDecoder` per channel at one row per cycle, with the
+    same latency. A channel whose entries would take more bits than its
+    rows is stored uncompressed. The build prints the compression ratio
+    per channel. Not available with the DDS, which needs random access to
+    the rows.
+
+    Built with `--interpolation 2`, `4` or `8`, each stored row is played
+    over that many `dac_clk` cycles through an `Interpolator` per channel
+    (polyphase FIR, 6 taps per phase, images below about -33 dB for
+    signals up to 0.4 of the stored Nyquist frequency). A pattern then
+    lasts that many times longer for the same BRAM. Stored samples are
+    reproduced exactly, delayed by 3 stored samples, after the filter
+    response to the zero history. The data path latency grows by 5
+    cycles. Not available with the DDS or `--compress`. Check the filter
+    with `interp_check.py`.
+
+    With DAC_SYNCen set, setting DAC_PLAY only arms playback. It starts
+    on the first `dac_clk` edge with SYNC (EEM 4) high. SYNC is captured
+    in the IOB and registered once more, so it must meet setup/hold to
+    `dac_clk` (common reference clock on all boards). The first sample
+    and DAC_ISTR reach the OSERDES 2 cycles plus the data path latency
+    after the IOB capture edge, together with a pulse on the DAC SYNC
+    pins: 10 `dac_clk` edges after the SYNC edge with the default data
+    path (`bench.py`, `sync_start`). Clearing DAC_PLAY stops playback as
+    before.
+
+    TRIG (EEM 5) is a low latency trigger, captured in the IOB and used
+    directly by the playback FSM. It must meet setup/hold to `dac_clk`.
+    Only its rising edge acts: the capture is compared with the previous
+    cycle, so a long TRIG pulse is one trigger and TRIG must be low for
+    at least one cycle before the next. The comparison is combinatorial
+    and adds no cycle. While DAC_PLAY is set:
+
+    * TRIG_START: playback waits for TRIG (or SYNC with DAC_SYNCen). TRIG
+      during playback restarts from the first row.
+    * TRIG_STOP: TRIG during playback stops it. Playback waits for a
+      start condition (TRIG_START, DAC_SYNCen) or for DAC_PLAY to be
+      cleared.
+    * Both: TRIG toggles between playing and stopped.
+
+    While waiting, the first row is already fetched. On start and restart,
+    DAC_ISTR and the first row reach the OSERDES 1 cycle plus the data
+    path latency after the TRIG capture edge. On stop, the output returns
+    to the first row (as when idle) one cycle later.
+
     REG3 - Attenuators control
 
     | Name      | Width | Function                           |
@@ -263,8 +1655,191 @@ class Phaser(Module):
     | LOCK DET  | 2     | Lock detect (redout)               |  2:4
     | PWR SAVE  | 2     | Power saving enabled, active high  |  0:2
 
+    STAT - Status snapshot (read-only)
+
+    All status bits in a single transfer. They are sampled together on the
+    8th falling SCK edge and give a coherent view.
+
+    | Name      | Width | Function                           |
+    |-----------+-------+------------------------------------|
+    | PLL_LOCK  | 1     | DAC clock PLL locked               | 13
+    | LOCK DET  | 2     | Upconverter lock detect            | 11:13
+    | DAC_PLAY  | 1     | Play samples embedded in BRAM      | 10
+    | DAC_ALARM | 1     | State of DAC alarm pin             |  9
+    | ASSY_VAR  | 1     | Assembly variant (see REG0)        |  8
+    | PROTO_REV | 2     | Protocol revision                  |  6:8
+    | HW_REV    | 4     | Hardware revision                  |  2:6
+    | TERM      | 2     | Termination, active high           |  0:2
+
+    BATCH - Atomic configuration update
+
+    | Name      | Width | Function                           |
+    |-----------+-------+------------------------------------|
+    | COMMIT    | 1     | Write: apply held writes           |  1
+    |           |       | Read: PENDING, writes are held     |
+    | BATCH     | 1     | Hold writes to REG0-REG4           |  0
+
+    While BATCH is set, writes to REG0-REG4 are held (the last write per
+    register) instead of being applied. A BATCH write with COMMIT set
+    applies all held writes together on its last falling SCK edge. A
+    write without COMMIT drops them. Writing BATCH|COMMIT commits and
+    keeps holding further writes. Register reads return the applied
+    values. Fields crossing into `dac_clk` are synchronized per bit and
+    may still see the update one `dac_clk` cycle apart.
+
+    CNT - Event counters
+
+    32 bit event counters, LSB half at the lower address. A write to any
+    CNT address latches (bit 0) and/or clears (bit 1) all counters. Reads
+    return the values latched by the last write.
+
+    | ADR   | Counter     | Event                              |
+    |-------+-------------+------------------------------------|
+    | 32:34 | FRAMES      | SPI transfers received             |
+    | 34:44 | REG0-4_WR   | Writes to REG0 to REG4             |
+    | 44:54 | DAC, TRF0-1,| SPI pass-through transfers to      |
+    |       | ATT0-1_XFER | DAC, TRF0, TRF1, ATT0, ATT1        |
+    | 54:56 | PLAY        | Playback starts (not restarts)     |
+    | 56:58 | LOOPS       | Completed pattern loops            |
+    | 58:60 | PLL_UNLOCK  | DAC clock PLL lock losses          |
+    | 60:62 | DAC_ALARM   | DAC alarm assertions               |
+
+    PLAY and LOOPS are cleared while the DAC clock PLL is unlocked.
+
+    IRQ - Interrupt line
+
+    See `IRQ` for the registers. IRQ (EEM 6) is high while an unmasked
+    cause is pending. Reading CAUSE clears the causes it returns, so a
+    handler reads CAUSE once per edge and loses nothing.
+
+    | Bit | Cause                                                    |
+    |-----+----------------------------------------------------------|
+    | 0   | DAC clock PLL lock change                                |
+    | 1   | DAC alarm assertion                                      |
+    | 2   | TRF0 lock detect change                                  |
+    | 3   | TRF1 lock detect change                                  |
+    | 4   | Playback stopped                                         |
+    | 5   | Pattern loop completed                                   |
+    | 6   | SPI sequence done                                        |
+
+    TQ - Timed command queue
+
+    See `TimedQueue` for the registers. Commands target the timed
+    registers below, in the `dac_clk` domain. The cycle counter counts
+    `dac_clk` cycles and restarts when the PLL loses lock. A command
+    scheduled for time T takes effect on the `dac_clk` edge ending cycle
+    T; data path latency downstream of the register applies on top.
+
+    T0 - Timed gain
+
+    | Name      | Width | Function                           |
+    |-----------+-------+------------------------------------|
+    | GAIN_EN   | 1     | Gains from T0 instead of REG3      |  4
+    | CH1_GAIN  | 2     | Channel 1 gain (see REG3)          |  2:4
+    | CH0_GAIN  | 2     | Channel 0 gain (see REG3)          |  0:2
+
+    T1 to T8 - Channel scale and offset
+
+    Pairs of SCALE (T1, T3, T5, T7) and OFFSET (T2, T4, T6, T8) for DAC
+    channels a to d. Samples from the pattern memory are taken as signed
+    16 bit and replaced with `((sample*SCALE) >> 14) + OFFSET`, rounded
+    and saturated. SCALE is signed Q2.14 and resets to 0x4000 (unity),
+    OFFSET resets to 0. Test patterns bypass the scaling. Changes reach
+    the OSERDES 6 cycles after the timed register update. With the
+    envelope enabled, SCALE is multiplied by the envelope first.
+
+    T9 to T14 - Envelope
+
+    | Adr | Name     | Function                                        |
+    |-----+----------+-------------------------------------------------|
+    | 9   | ENV_CTRL | 0: EN, 1: TABLE, 2: LOOP                        |
+    | 10  | RISE     | Rise phase step (ramp `2**20/RISE` cycles)      |
+    | 11  | HOLD     | Cycles at full scale between rise and fall      |
+    | 12  | FALL     | Fall phase step (ramp `2**20/FALL` cycles)      |
+    | 13  | TADR     | Shape table address (write only)                |
+    | 14  | TDAT     | Shape table entry at TADR, TADR incremented     |
+
+    See `Envelope`. With EN set, the channel scales are multiplied by the
+    envelope (unsigned Q2.14). It starts at 0 with the first row of each
+    playback start or restart, and with LOOP also on every pattern wrap.
+    TABLE selects the 256 entry shape table (rise shape, the fall mirrors
+    it) instead of linear ramps. HOLD is latched at the end of the rise.
+
+    T15, T16 - Table lookup DDS
+
+    | Adr | Name     | Function                                        |
+    |-----+----------+-------------------------------------------------|
+    | 15  | DDS_CTRL | 0: EN, 1: INTERP                                |
+    | 16  | STEP     | Phase step per sample, 2**-16 samples           |
+
+    Only present if built with the DDS (`--dds`). See `DDS`. With EN set,
+    the pattern memory is read as a waveform table at fractional rate
+    STEP/2**16 instead of one row per cycle, with linear interpolation
+    between samples if INTERP is set. All channels share the phase. It
+    starts at 0 with playback and restarts with it. The playback FSM and
+    DAC_ISTR still count rows, so LOOPS counts pattern length cycles.
+    STEP is below one sample, so the output frequency stays below the
+    sample rate divided by the pattern length, per period stored in the
+    pattern (see `DDS`).
+
+    T17 to T20 - IQ mixer
+
+    | Adr | Name     | Function                                        |
+    |-----+----------+-------------------------------------------------|
+    | 17  | MIX_CTRL | 0: EN                                           |
+    | 18  | FTW_LO   | NCO frequency tuning word, bits 0:16            |
+    | 19  | FTW_HI   | FTW bits 16:32, applies FTW_LO and FTW_HI       |
+    | 20  | POW      | NCO phase offset, 2**-16 turns                  |
+
+    Only present if built with the IQ mixer (`--iq-mixer`), meant for the
+    upconverter variant (ASSY_VAR 0) where channels a/b and c/d drive the
+    TRF I/Q inputs. See `IQMixer`. With EN set, each I/Q pair from the
+    pattern memory (or DDS) is rotated by the NCO at
+    `FTW/2**32*f_sample` (signed, 4 samples per `dac_clk` cycle) before
+    scale and offset. The NCO phase is POW at the first row of each
+    playback start and restart.
+
+    T21 - SPI sequencer fire
+
+    A write fires the SPI sequencer at the entry given by the data (see
+    SEQ below).
+
+    SEQ - SPI sequencer
+
+    See `SPISeq` for the registers. Plays preloaded word lists to the TRF
+    (DEV 0, 1) and attenuator (DEV 2, 3) buses in the `dac_clk` domain,
+    fired by FIRE, by a TRIG (EEM 5) rising edge with TRIG_EN, or by a
+    timed write to T21. While BUSY, the sequencer drives the TRF and
+    attenuator clock, data and LE pins and the host pass-through (TRF0-1,
+    ATT0-1) must not be used. `sck` defaults to `dac_clk/4`.
+
+    CRC - Pattern memory CRC
+
+    See `PatternCRC` for the registers. Channels a to d are memories 0 to
+    3. The CRC covers the stored words: the pattern rows, or the encoded
+    entries of the channels stored compressed with `--compress`. A sweep takes one `dac_clk` cycle
+    per word and can run during playback. With the DDS enabled it
+    borrows the DDS memory port and disturbs the output.
+
+    TRC - Trace buffer
+
+    Only present if built with a trace depth (`--trace-depth`). See `Trace`
+    for the registers. The sample layout is `trace_layout` (LSB first),
+    sampled in the `dac_clk` domain. Trigger mask bits (CTRL 1:6):
+
+    | Bit | Trigger                                                  |
+    |-----+----------------------------------------------------------|
+    | 1   | EEM CS edge                                              |
+    | 2   | Register write (REG0 to REG4)                            |
+    | 3   | Playback FSM state change                                |
+    | 4   | DAC_ISTR rising edge                                     |
+    | 5   | Immediately                                              |
+
+    `trace2vcd.py` converts a readout to VCD.
+
     """
-    def __init__(self, platform, memory_contents):
+    def __init__(self, platform, memory_contents, trace_depth=0, sample_rate=125e6,
+                 dds=False, iq_mixer=False, compress=False, interpolation=1):
         self.eem = eem = [Signal() for _ in range(4)]
         eemi = [platform.request("lvds", i) for i in range(4)]
         for i, (sig, pad) in enumerate(zip(eem, eemi)):
@@ -293,7 +1868,7 @@ class Phaser(Module):
         ]
 
         self.submodules.sr = SR()
-        mask = 0b0001111
+        mask = 0b1111111
 
         self.comb += [
             self.sr.ext.sck.eq(self.cd_sck.clk),
@@ -305,16 +1880,30 @@ class Phaser(Module):
         # Registers
 
         regs = [
-            REG(width=9),
-            REG(width=9),
-            REG(width=7),
-            REG(width=4),
-            REG(width=4)
+            REG(width=9, batch=True),
+            REG(width=9, batch=True),
+            REG(width=12, batch=True),
+            REG(width=4, batch=True),
+            REG(width=4, batch=True)
         ]
         self.submodules += regs
         for i, reg in enumerate(regs):
             self.sr.connect(reg.bus, adr=i, mask=mask)
 
+        # batched configuration updates, see BATCH
+        batch = REG(width=2)
+        self.submodules += batch
+        self.sr.connect(batch.bus, adr=6 + len(regs), mask=mask)
+        self.comb += [
+            batch.read.eq(Cat(batch.write[0],
+                              reduce(or_, [reg.pending for reg in regs]))),
+            [[
+                reg.batch.eq(batch.write[0]),
+                reg.commit.eq(batch.bus.we & batch.bus.dat_w[1]),
+                reg.discard.eq(batch.bus.we & ~batch.bus.dat_w[1]),
+            ] for reg in regs],
+        ]
+
         assy_variant = platform.request("assy_variant")
         hw_rev = platform.request("hw_rev")
         term_stat = platform.request("term_stat")
@@ -325,6 +1914,10 @@ class Phaser(Module):
         
         dac_ifreset = Signal()
         dac_test_pattern_en = Signal()
+        dac_sync_en = Signal()
+        dac_trig_start_en = Signal()
+        dac_trig_stop_en = Signal()
+        dac_prbs = Signal(2)
         dac_play = Signal()
         dac_alarm = platform.request("dac_alarm")
         dac_resetb = platform.request("dac_resetb")
@@ -341,7 +1934,8 @@ class Phaser(Module):
             # Readout
             regs[0].read.eq(Cat(term_stat, hw_rev, Constant(__proto_rev__, 2), assy_variant)),
             regs[1].read.eq(regs[1].write),
-            regs[2].read.eq(Cat(regs[2].write[0:3], dac_alarm, dac_play, dac_ifreset, dac_test_pattern_en)),
+            regs[2].read.eq(Cat(regs[2].write[0:3], dac_alarm, dac_play, dac_ifreset, dac_test_pattern_en, dac_sync_en,
+                                dac_trig_start_en, dac_trig_stop_en, dac_prbs)),
             regs[3].read.eq(regs[3].write),
             regs[4].read.eq(Cat(regs[0].write[0:2], trf_ld)),
 
@@ -349,6 +1943,10 @@ class Phaser(Module):
             clk_sel.eq(regs[1].write[6]),
             att_rstn.eq(regs[1].write[7:9]),
 
+            dac_prbs.eq(regs[2].write[10:12]),
+            dac_trig_stop_en.eq(regs[2].write[9]),
+            dac_trig_start_en.eq(regs[2].write[8]),
+            dac_sync_en.eq(regs[2].write[7]),
             dac_test_pattern_en.eq(regs[2].write[6]),
             dac_ifreset.eq(~regs[2].write[5]),
             dac_play.eq(regs[2].write[4]),
@@ -356,13 +1954,11 @@ class Phaser(Module):
             dac_sleep.eq(regs[2].write[1]),
             dac_txena.eq(regs[2].write[0]),
 
-            gain_ch0.eq(regs[3].write[0:2]),
-            gain_ch1.eq(regs[3].write[2:4]),
-
             trf_ps.eq(regs[4].write[0:2])
         ]
 
         self.clock_domains.cd_dac_clk = ClockDomain()
+        self.clock_domains.cd_dac_clk_nr = ClockDomain(reset_less=True)
         self.clock_domains.cd_dac_clk4x = ClockDomain(reset_less=True)
         self.clock_domains.cd_clk125_div2 = ClockDomain(reset_less=True)
         self.clock_domains.cd_clk_gtp_div2 = ClockDomain(reset_less=True)
@@ -371,7 +1967,6 @@ class Phaser(Module):
         clk125m_pads = platform.request("clk125")
         self.specials += Instance("IBUFDS_GTE2", o_ODIV2=clk125_div2, i_I=clk125m_pads.p, i_IB=clk125m_pads.n, i_CEB=False)
         self.cd_clk125_div2.clk.attr.add(("keep", "true"))
-        self.cd_clk125_div2.clk.attr.add(("mark_dbg_hub_clk", "true"))
         self.specials += Instance("BUFG", i_I=clk125_div2, o_O=self.cd_clk125_div2.clk)
         platform.add_period_constraint(self.cd_clk125_div2.clk, 16.)
 
@@ -387,15 +1982,15 @@ class Phaser(Module):
         dac_clk_shift = Signal()
         dac_clk4x_shift = Signal()
         fb_clk = Signal()
-        # pll_clk200 = Signal()
-        
+        pll = solve_pll(62.5e6, sample_rate)
+
         self.specials += [
             Instance("PLLE2_BASE",
                      p_STARTUP_WAIT="FALSE", 
                      p_BANDWIDTH="HIGH",
                      p_CLKIN1_PERIOD=16.0, 
-                     p_CLKFBOUT_MULT=16, # VCO 1000 MHz
-                     p_DIVCLK_DIVIDE=1,
+                     p_CLKFBOUT_MULT=pll["CLKFBOUT_MULT"],
+                     p_DIVCLK_DIVIDE=pll["DIVCLK_DIVIDE"],
                      
                      i_CLKIN1=ClockSignal("clk_gtp_div2"),
                      i_CLKFBIN=fb_clk,
@@ -404,26 +1999,83 @@ class Phaser(Module):
                     #  i_RST=self.cd_sys.rst,
                      o_LOCKED=pll_locked,
 
-                     p_CLKOUT0_DIVIDE=8, p_CLKOUT0_PHASE=0.0,
-                     o_CLKOUT0=dac_clk4x,  # 125 MHz
+                     p_CLKOUT0_DIVIDE=pll["DIVIDE_4X"], p_CLKOUT0_PHASE=0.0,
+                     o_CLKOUT0=dac_clk4x,
 
-                     p_CLKOUT1_DIVIDE=32, p_CLKOUT1_PHASE=0.0,
-                     o_CLKOUT1=dac_clk,   # 32.5 MHz
+                     p_CLKOUT1_DIVIDE=pll["DIVIDE"], p_CLKOUT1_PHASE=0.0,
+                     o_CLKOUT1=dac_clk,
 
-                     p_CLKOUT2_DIVIDE=8, p_CLKOUT2_PHASE=90,
+                     p_CLKOUT2_DIVIDE=pll["DIVIDE_4X"], p_CLKOUT2_PHASE=90.0,
                      o_CLKOUT2=dac_clk4x_shift,
 
-                     p_CLKOUT3_DIVIDE=32, p_CLKOUT3_PHASE=90,
+                     p_CLKOUT3_DIVIDE=pll["DIVIDE"], p_CLKOUT3_PHASE=90.0,
                      o_CLKOUT3=dac_clk_shift
-                     
-                 
                      ),
             Instance("BUFG", i_I=dac_clk, o_O=self.cd_dac_clk.clk),
             Instance("BUFG", i_I=dac_clk4x, o_O=self.cd_dac_clk4x.clk),
             AsyncResetSynchronizer(self.cd_dac_clk, ~pll_locked),
         ]
-        platform.add_period_constraint(self.cd_dac_clk.clk, 8.)
-        platform.add_period_constraint(self.cd_dac_clk4x.clk, 2.)
+        self.comb += self.cd_dac_clk_nr.clk.eq(self.cd_dac_clk.clk)
+        platform.add_period_constraint(self.cd_dac_clk.clk, 1e9/pll["f"])
+        platform.add_period_constraint(self.cd_dac_clk4x.clk, 1e9/pll["f_4x"])
+
+        status = REG(width=14, write=False)
+        self.submodules += status
+        self.sr.connect(status.bus, adr=5 + len(regs), mask=mask)
+        self.comb += status.read.eq(Cat(regs[0].read, dac_alarm, dac_play, trf_ld, pll_locked))
+
+        # Timed command queue
+
+        self.submodules.tq = TimedQueue(cd_fifo="dac_clk_nr")
+        self.sr.connect(self.tq.bus, adr=0b0010000, mask=0b1111000)
+
+        # timed registers, written through the queue
+        tregs = [
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(width=5, read=False)),
+        ]
+        for ch in "abcd":
+            tregs += [
+                ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False, reset=0x4000)),
+                ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+            ]
+        tregs += [
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(width=3, read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+        ]
+        # 13, 14: envelope table, decoded by `Envelope`
+        tregs += [None, None]
+        tregs += [
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(width=2, read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+        ]
+        tregs += [
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(width=1, read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+            ClockDomainsRenamer({"reg": "dac_clk"})(REG(read=False)),
+        ]
+        # 21: SPI sequencer fire, decoded by `SPISeq`
+        tregs += [None]
+        self.submodules += [treg for treg in tregs if treg is not None]
+        for i, treg in enumerate(tregs):
+            if treg is None:
+                continue
+            self.comb += [
+                treg.bus.dat_w.eq(self.tq.out.dat_w),
+                treg.bus.we.eq(self.tq.out.we & (self.tq.out.adr == i)),
+            ]
+
+        self.comb += [
+            If(tregs[0].write[4],
+                gain_ch0.eq(tregs[0].write[0:2]),
+                gain_ch1.eq(tregs[0].write[2:4]),
+            ).Else(
+                gain_ch0.eq(regs[3].write[0:2]),
+                gain_ch1.eq(regs[3].write[2:4]),
+            ),
+        ]
 
         dac_play_dac_clk = Signal()
         dac_oe = Signal()
@@ -434,38 +2086,129 @@ class Phaser(Module):
         memory_depth = pattern_length // 4
         memory_address = Signal(max=memory_depth)
 
+        dac_test_pattern_en_dac_clk = Signal()
+        self.specials += MultiReg(dac_test_pattern_en, dac_test_pattern_en_dac_clk, "dac_clk")
+
+        dac_sync_en_dac_clk = Signal()
+        self.specials += MultiReg(dac_sync_en, dac_sync_en_dac_clk, "dac_clk")
+
+        # Multi-board synchronized start
+        sync_in = Signal()
+        sync_iob = Signal(reset_less=True)
+        sync_iob.attr.add(("IOB", "TRUE"))
+        sync_r = Signal(reset_less=True)
+        sync_pads = platform.request("lvds", 4)
+        self.specials += DifferentialInput(sync_pads.p, sync_pads.n, sync_in)
+        self.sync.dac_clk += [
+            sync_iob.eq(sync_in),
+            sync_r.eq(sync_iob),
+        ]
+
+        # Low latency trigger
+        trig_in = Signal()
+        trig = Signal(reset_less=True)
+        trig.attr.add(("IOB", "TRUE"))
+        trig_pads = platform.request("lvds", 5)
+        self.specials += DifferentialInput(trig_pads.p, trig_pads.n, trig_in)
+        trig_r = Signal(reset_less=True)
+        trig_edge = Signal()
+        self.sync.dac_clk += [
+            trig.eq(trig_in),
+            trig_r.eq(trig),
+        ]
+        self.comb += trig_edge.eq(trig & ~trig_r)
+
+        trig_start_en = Signal()
+        trig_stop_en = Signal()
+        self.specials += [
+            MultiReg(dac_trig_start_en, trig_start_en, "dac_clk"),
+            MultiReg(dac_trig_stop_en, trig_stop_en, "dac_clk"),
+        ]
+
+        # pre-armed: IDLE and STOPPED hold memory_address at 0 so that the
+        # first row is already fetched when the start condition arrives
+        dac_start = Signal()
+        dac_restart = Signal()
+        self.comb += [
+            dac_start.eq(dac_play_dac_clk & (
+                (dac_sync_en_dac_clk & sync_r) | (trig_start_en & trig_edge))),
+            dac_restart.eq(trig_edge & trig_start_en & ~trig_stop_en),
+        ]
+
         dac_istr = Signal()
-        self.specials += DifferentialOutput(dac_istr, platform.request("dac_istr_p"), platform.request("dac_istr_n"))
+        dac_sync = Signal()
+        memory_read_address = Signal(max=memory_depth)
+
+        # with interpolation, each row is read for `interpolation` cycles
+        # and the address advances after `row_next`
+        first_address = 1 if interpolation == 1 else 0
+        row_next = Signal()
+        pattern_end = Signal()
 
         fsm = ClockDomainsRenamer("dac_clk")(FSM(reset_state="IDLE"))
         self.submodules += fsm
-        
-        fsm.act("IDLE", 
+
+        start = [
+            NextValue(dac_istr, 1),
+            NextValue(dac_sync, 1),
+            NextState("PLAY"),
+            NextValue(memory_address, first_address),
+            NextValue(dac_oe, 1),
+        ]
+
+        fsm.act("IDLE",
+                NextValue(dac_oe, 0),
+                NextValue(dac_istr, 0),
+                NextValue(dac_sync, 0),
+                NextValue(memory_address, 0),
+                If(dac_start | (dac_play_dac_clk & ~dac_sync_en_dac_clk & ~trig_start_en),
+                   *start
+                )
+        )
+
+        fsm.act("STOPPED",
                 NextValue(dac_oe, 0),
                 NextValue(dac_istr, 0),
+                NextValue(dac_sync, 0),
                 NextValue(memory_address, 0),
-                If(dac_play_dac_clk,
-                   NextValue(dac_istr, 1),
-                   NextState("PLAY"),
-                   NextValue(memory_address, memory_address+1),
-                   NextValue(dac_oe, 1),
+                If(~dac_play_dac_clk,
+                    NextState("IDLE"),
+                ).Elif(dac_start,
+                    *start
                 )
         )
 
         fsm.act("PLAY",
                 NextValue(dac_oe, 1),
                 NextValue(dac_istr, 0),
+                NextValue(dac_sync, 0),
+                If(row_next,
+                    If(memory_address >= memory_depth-1,
+                        NextValue(memory_address, 0),
+                        If(dac_test_pattern_en_dac_clk, NextValue(dac_istr, 1)),
+                    ).Else(
+                       NextValue(memory_address, memory_address+1)
+                    ),
+                ),
                 If(~dac_play_dac_clk,
                     NextState("IDLE"),
                     NextValue(dac_oe, 0),
-                ),
-                If(memory_address >= memory_depth-1,
+                ).Elif(trig_edge & trig_stop_en,
+                    NextState("STOPPED"),
+                    NextValue(dac_oe, 0),
                     NextValue(memory_address, 0),
-                    If(dac_test_pattern_en, NextValue(dac_istr, 1)),
-                ).Else(
-                   NextValue(memory_address, memory_address+1)
+                ).Elif(dac_restart,
+                    NextValue(dac_istr, 1),
+                    NextValue(dac_sync, 1),
+                    NextValue(memory_address, first_address),
                 )
         )
+        self.comb += [
+            memory_read_address.eq(memory_address),
+            If(fsm.ongoing("PLAY") & dac_restart,
+                memory_read_address.eq(0),
+            ),
+        ]
 
         dac_channel_data = {
             "a": Signal(64),
@@ -480,19 +2223,259 @@ class Phaser(Module):
             "c": Signal(64, reset=0xAAAAEAEAAAAAEAEA),
             "d": Signal(64, reset=0xC6C64545C6C64545)
         }
-        dac_test_pattern_mask = Signal(64)
+        # dac_clk cycles from memory_address to dac_channel_data
+        # beyond the BRAM read, dac_istr is delayed to match
+        dac_latency = 0
+
+        pattern_start = Signal()
+        pattern_wrap = Signal()
+        self.comb += pattern_start.eq(fsm.before_entering("PLAY") |
+            (fsm.ongoing("PLAY") & dac_play_dac_clk & dac_restart))
+        self.comb += pattern_end.eq(fsm.ongoing("PLAY") & row_next &
+                                    (memory_address >= memory_depth-1))
+        self.sync.dac_clk += pattern_wrap.eq(pattern_end)
+        if interpolation > 1:
+            row_cnt = Signal(max=interpolation)
+            self.sync.dac_clk += [
+                row_cnt.eq(row_cnt + 1),
+                If(pattern_start,
+                    row_cnt.eq(0),
+                ),
+            ]
+            self.comb += row_next.eq(row_cnt == interpolation - 2)
+        else:
+            self.comb += row_next.eq(1)
+
+        # Table lookup DDS (T15, T16)
+        if dds and compress:
+            raise ValueError("the DDS needs uncompressed patterns")
+        if interpolation != 1 and (dds or compress):
+            raise ValueError("the interpolator needs uncompressed patterns "
+                             "and no DDS")
+        dds_ctrl = tregs[15].write
+        # start/run are registered (off the trigger to FSM path): the DDS
+        # runs one cycle behind the FSM
+        dds_latency = DDS.latency + 1
+        if dds:
+            self.submodules.dds = DDS(pattern_length)
+            self.comb += [
+                self.dds.step.eq(tregs[16].write),
+                self.dds.interp.eq(dds_ctrl[1]),
+            ]
+            self.sync.dac_clk += [
+                self.dds.start.eq(pattern_start),
+                self.dds.run.eq(fsm.ongoing("PLAY")),
+            ]
+
+        # BRAM output register, or compressed pattern decoder
+        samples = {}
+        self.compression = {}
+        crc_memories = []
+        crc_ports = []
+        for i, ch in enumerate("abcd"):
+            entries = None
+            if compress:
+                entries = encode_rows(memory_contents[ch][:memory_depth])
+                self.compression[ch] = memory_depth, len(entries)
+                if len(entries)*72 > memory_depth*64:
+                    entries = None  # larger than the rows, store those
+            if entries is not None:
+                decoder = RowDecoder(entries)
+                self.submodules += decoder
+                self.comb += [
+                    decoder.start.eq(pattern_start),
+                    decoder.run.eq(fsm.ongoing("PLAY")),
+                ]
+                samples[ch] = decoder.o
+                crc_memories.append((72, len(entries)))
+                crc_ports.append((decoder.read_adr, decoder.read_dat))
+                continue
 
-        for ch in "abcd":
             mem = Memory(depth=memory_depth, width=64, init=memory_contents[ch])
             read_port = mem.get_port(clock_domain="dac_clk")
             self.specials += mem, read_port
-            
+            samples[ch] = Signal(64, reset_less=True)
+
+            self.comb += read_port.adr.eq(memory_read_address)
+            self.sync.dac_clk += samples[ch].eq(read_port.dat_r)
+
+            # second port: DDS and CRC
+            port = mem.get_port(clock_domain="dac_clk")
+            self.specials += port
+            crc_memories.append((64, memory_depth))
+            crc_ports.append((port.adr, port.dat_r))
+            if dds:
+                self.comb += [
+                    If(dds_ctrl[0],
+                        read_port.adr.eq(self.dds.adr[0]),
+                    ),
+                    self.dds.dat[i][0].eq(read_port.dat_r),
+                    self.dds.dat[i][1].eq(port.dat_r),
+                ]
+        dac_latency += 1
+
+        # Pattern memory CRC, borrows the second port from the DDS
+        self.submodules.crc = PatternCRC(crc_memories)
+        self.sr.connect(self.crc.bus, adr=0b1010000, mask=0b1110000)
+        for i, (adr, dat_r) in enumerate(crc_ports):
+            self.comb += [
+                adr.eq(self.crc.adr[i]),
+                self.crc.dat[i].eq(dat_r),
+            ]
+            if dds:
+                self.comb += If(~self.crc.reading, adr.eq(self.dds.adr[1]))
+
+        if dds:
+            for i, ch in enumerate("abcd"):
+                for j in range(dds_latency - 1):
+                    delayed = Signal(64, reset_less=True)
+                    self.sync.dac_clk += delayed.eq(samples[ch])
+                    samples[ch] = delayed
+                selected = Signal(64)
+                self.comb += selected.eq(Mux(dds_ctrl[0], self.dds.o[i], samples[ch]))
+                samples[ch] = selected
+            dac_latency += dds_latency - 1
+
+        # first row at `samples` 2 cycles after row_start
+        row_start, row_wrap = pattern_start, pattern_wrap
+        if dds:
+            for j in range(dds_latency - 1):
+                delayed = Signal(2)
+                self.sync.dac_clk += delayed.eq(Cat(row_start, row_wrap))
+                row_start, row_wrap = delayed[0], delayed[1]
+
+        # Polyphase interpolation, one stored row per `interpolation` cycles
+        if interpolation > 1:
+            for ch in "abcd":
+                interpolator = Interpolator(interpolation)
+                self.submodules += interpolator
+                self.comb += [
+                    interpolator.start.eq(row_start),
+                    interpolator.i.eq(samples[ch]),
+                ]
+                samples[ch] = interpolator.o
+            dac_latency += Interpolator.latency
+            for j in range(Interpolator.latency):
+                delayed = Signal(2)
+                self.sync.dac_clk += delayed.eq(Cat(row_start, row_wrap))
+                row_start, row_wrap = delayed[0], delayed[1]
+
+        # IQ mixer (T17 to T20), a/b and c/d are I/Q pairs
+        if iq_mixer:
+            # registered start (off the trigger to FSM path), the samples
+            # are delayed to match
+            for ch in "abcd":
+                delayed = Signal(64, reset_less=True)
+                self.sync.dac_clk += delayed.eq(samples[ch])
+                samples[ch] = delayed
+            delayed = Signal(2)
+            self.sync.dac_clk += delayed.eq(Cat(row_start, row_wrap))
+            row_start, row_wrap = delayed[0], delayed[1]
+            dac_latency += 1
+
+            ftw = Signal(32)
+            self.sync.dac_clk += If(tregs[19].bus.we,
+                ftw.eq(Cat(tregs[18].write, tregs[19].bus.dat_w)),
+            )
+            self.submodules.iq_mixer = IQMixer()
+            self.comb += [
+                self.iq_mixer.ftw.eq(ftw),
+                self.iq_mixer.pow.eq(tregs[20].write),
+                self.iq_mixer.start.eq(row_start),
+            ]
+            for i, pair in enumerate(("ab", "cd")):
+                for j, ch in enumerate(pair):
+                    self.comb += self.iq_mixer.i[i][j].eq(samples[ch])
+                    delayed = samples[ch]
+                    for k in range(IQMixer.latency):
+                        delayed_next = Signal(64, reset_less=True)
+                        self.sync.dac_clk += delayed_next.eq(delayed)
+                        delayed = delayed_next
+                    selected = Signal(64)
+                    self.comb += selected.eq(Mux(tregs[17].write[0],
+                        self.iq_mixer.o[i][j], delayed))
+                    samples[ch] = selected
+            dac_latency += IQMixer.latency
+            for j in range(IQMixer.latency):
+                delayed = Signal(2)
+                self.sync.dac_clk += delayed.eq(Cat(row_start, row_wrap))
+                row_start, row_wrap = delayed[0], delayed[1]
+
+        # Envelope (T9 to T14), started with the first row
+        env_ctrl = tregs[9].write
+
+        self.submodules.envelope = envelope = Envelope()
+        env = Signal(15)
+        self.comb += [
+            envelope.start.eq(row_start | (env_ctrl[2] & row_wrap)),
+            envelope.table.eq(env_ctrl[1]),
+            envelope.rise.eq(tregs[10].write),
+            envelope.hold.eq(tregs[11].write),
+            envelope.fall.eq(tregs[12].write),
+            envelope.dat_w.eq(self.tq.out.dat_w),
+            envelope.table_adr_we.eq(self.tq.out.we & (self.tq.out.adr == 13)),
+            envelope.table_dat_we.eq(self.tq.out.we & (self.tq.out.adr == 14)),
+            env.eq(Mux(env_ctrl[0], envelope.env, 0x4000)),
+        ]
+        # envelope valid 1 + Envelope.latency cycles after row_start,
+        # the first row is at `samples` 2 cycles after
+        for ch in "abcd":
+            delayed = Signal(64, reset_less=True)
+            self.sync.dac_clk += delayed.eq(samples[ch])
+            samples[ch] = delayed
+        dac_latency += 1
+
+        # Scale and offset (T1 to T8), envelope folded into the scale
+        for i, ch in enumerate("abcd"):
+            scaler = ScaleOffset()
+            self.submodules += scaler
+            scale_reg = Signal((16, True))
+            scale = Signal((32, True), reset_less=True)
+            self.sync.dac_clk += scale.eq(scale_reg*env)
             self.comb += [
-                read_port.adr.eq(memory_address),
-                If(dac_test_pattern_en, dac_test_pattern_mask.eq(0xFFFFFFFFFFFFFFFF)).Else(dac_test_pattern_mask.eq(0)),
-                dac_channel_data[ch].eq(
-                    (read_port.dat_r & ~dac_test_pattern_mask) | (dac_test_patterns[ch] & dac_test_pattern_mask))
+                scale_reg.eq(tregs[1 + 2*i].write),
+                scaler.i.eq(samples[ch]),
+                scaler.scale.eq(scale >> 14),
+                scaler.offset.eq(tregs[2 + 2*i].write),
+            ]
+            samples[ch] = scaler.o
+        dac_latency += ScaleOffset.latency
+
+        # PRBS per lane, bit order as serialized by the OSERDES below:
+        # lane i of pair xy sends x[i], y[i], x[16 + i], y[16 + i], ...
+        self.submodules.prbs = PRBS(lanes=32)
+        self.specials += MultiReg(dac_prbs, self.prbs.mode, "dac_clk")
+        prbs_data = {ch: Signal(64) for ch in "abcd"}
+        for j, (x, y) in enumerate(["ab", "cd"]):
+            for line_idx in range(16):
+                o = self.prbs.o[16*j + line_idx]
+                for k in range(4):
+                    self.comb += [
+                        prbs_data[x][k*16 + line_idx].eq(o[2*k]),
+                        prbs_data[y][k*16 + line_idx].eq(o[2*k + 1]),
+                    ]
+
+        # Registered test pattern mux
+        for ch in "abcd":
+            self.sync.dac_clk += [
+                If(self.prbs.mode != 0,
+                    dac_channel_data[ch].eq(prbs_data[ch]),
+                ).Elif(dac_test_pattern_en_dac_clk,
+                    dac_channel_data[ch].eq(dac_test_patterns[ch]),
+                ).Else(
+                    dac_channel_data[ch].eq(samples[ch]),
+                ),
             ]
+        dac_latency += 1
+
+        dac_istr_pipe = [Cat(dac_istr, dac_sync)]
+        for i in range(dac_latency):
+            dac_istr_pipe.append(Signal(2))
+            self.sync.dac_clk += dac_istr_pipe[-1].eq(dac_istr_pipe[-2])
+        self.specials += [
+            DifferentialOutput(dac_istr_pipe[-1][0], platform.request("dac_istr_p"), platform.request("dac_istr_n")),
+            DifferentialOutput(dac_istr_pipe[-1][1], platform.request("dac_sync_p"), platform.request("dac_sync_n")),
+        ]
 
         serdes_out = Signal()
         self.specials += Instance("OSERDESE2",
@@ -569,81 +2552,177 @@ class Phaser(Module):
         # SPI buses
 
         # DAC
-        ext = Record(ext_layout)
-        self.sr.connect_ext(ext, adr=0 + len(regs), mask=mask)
+        dac_ext = Record(ext_layout)
+        self.sr.connect_ext(dac_ext, adr=0 + len(regs), mask=mask)
+
+        self.comb += [
+            platform.request("dac_sdenb").eq(~dac_ext.cs),
+            platform.request("dac_sclk").eq(dac_ext.sck),
+            platform.request("dac_sdio").eq(dac_ext.sdi),
+            dac_ext.sdo.eq(platform.request("dac_sdo"))
+        ]
 
+        # TRF and attenuator sequencer, owns the pins while busy
+        self.submodules.spi_seq = SPISeq()
+        self.sr.connect(self.spi_seq.bus, adr=0b1001000, mask=0b1111000)
         self.comb += [
-            platform.request("dac_sdenb").eq(~ext.cs),
-            platform.request("dac_sclk").eq(ext.sck),
-            platform.request("dac_sdio").eq(ext.sdi),
-            ext.sdo.eq(platform.request("dac_sdo"))
+            self.spi_seq.trig.eq(trig_edge),
+            self.spi_seq.fire.eq(self.tq.out.we & (self.tq.out.adr == 21)),
+            self.spi_seq.fire_adr.eq(self.tq.out.dat_w),
         ]
 
+        def seq_mux(ext, seq):
+            muxed = Record(ext_layout)
+            self.comb += [
+                muxed.sck.eq(Mux(self.spi_seq.busy, seq.sck, ext.sck)),
+                muxed.sdi.eq(Mux(self.spi_seq.busy, seq.sdi, ext.sdi)),
+                muxed.cs.eq(Mux(self.spi_seq.busy, seq.cs, ext.cs)),
+            ]
+            return muxed
+
         trf_ext = []
 
         for i in range(2):
             ext = Record(ext_layout)
             trf_ext.append(ext)
             self.sr.connect_ext(ext, adr=1 + len(regs) + i, mask=mask)
+            muxed = seq_mux(ext, self.spi_seq.ext[i])
             self.comb += [
-                platform.request("trf_clk", i).eq(ext.sck),
-                platform.request("trf_data", i).eq(ext.sdi),
-                platform.request("trf_le", i).eq(~ext.cs),
+                platform.request("trf_clk", i).eq(muxed.sck),
+                platform.request("trf_data", i).eq(muxed.sdi),
+                platform.request("trf_le", i).eq(~muxed.cs),
                 ext.sdo.eq(platform.request("trf_rdbk", i))
             ]
 
-        ext = Record(ext_layout)
+        att_ext = []
+
         for i in range(2):
+            ext = Record(ext_layout)
+            att_ext.append(ext)
             self.sr.connect_ext(ext, adr=3 + len(regs) + i, mask=mask)
+            muxed = seq_mux(ext, self.spi_seq.ext[2 + i])
             self.comb += [
-                platform.request("att_clk", i).eq(ext.sck),
-                platform.request("att_s_in", i).eq(ext.sdi),
-                platform.request("att_le", i).eq(~ext.cs),
+                platform.request("att_clk", i).eq(muxed.sck),
+                platform.request("att_s_in", i).eq(muxed.sdi),
+                platform.request("att_le", i).eq(~muxed.cs),
                 ext.sdo.eq(platform.request("att_s_out", i))
             ]
 
-        # Debug
-
-        # platform.toolchain.post_synthesis_commands.append(
-        #     "source /home/ms/data/pw/cosyquanta/projects/phaser_debug/gateware/insert_ila.tcl")
-        # platform.toolchain.post_synthesis_commands.append(
-        #     "batch_insert_ila {16384}")
-        # platform.toolchain.post_synthesis_commands.append(
-        #     "connect_debug_port dbg_hub/clk [get_nets -hierarchical -filter {mark_dbg_hub_clk == true}]")
-
-        # # Debug nets definition
-
-        # trf_ext[0].cs.attr.add(("mark_debug", "true"))
-        # trf_ext[0].cs.attr.add(("mark_debug_clock", "clk125_clk"))
-        # trf_ext[0].sck.attr.add(("mark_debug", "true"))
-        # trf_ext[0].sck.attr.add(("mark_debug_clock", "clk125_clk"))
-        # trf_ext[0].sdi.attr.add(("mark_debug", "true"))
-        # trf_ext[0].sdi.attr.add(("mark_debug_clock", "clk125_clk"))
-        # trf_ext[0].sdo.attr.add(("mark_debug", "true"))
-        # trf_ext[0].sdo.attr.add(("mark_debug_clock", "clk125_clk"))
-
-        # trf_ext[1].cs.attr.add(("mark_debug", "true"))
-        # trf_ext[1].cs.attr.add(("mark_debug_clock", "clk125_clk"))
-        # trf_ext[1].sck.attr.add(("mark_debug", "true"))
-        # trf_ext[1].sck.attr.add(("mark_debug_clock", "clk125_clk"))
-        # trf_ext[1].sdi.attr.add(("mark_debug", "true"))
-        # trf_ext[1].sdi.attr.add(("mark_debug_clock", "clk125_clk"))
-        # trf_ext[1].sdo.attr.add(("mark_debug", "true"))
-        # trf_ext[1].sdo.attr.add(("mark_debug_clock", "clk125_clk"))
-
-        # dac_csn.attr.add(("mark_debug", "true"))
-        # dac_sclk.attr.add(("mark_debug", "true"))
-        # dac_sdi.attr.add(("mark_debug", "true"))
-        # dac_sdo.attr.add(("mark_debug", "true"))
+        # Counters
+
+        dac_alarm_gtp = Signal()
+        dac_alarm_gtp_r = Signal()
+        pll_locked_gtp = Signal()
+        pll_locked_gtp_r = Signal()
+        self.specials += [
+            MultiReg(dac_alarm, dac_alarm_gtp, "clk_gtp_div2"),
+            MultiReg(pll_locked, pll_locked_gtp, "clk_gtp_div2"),
+        ]
+        self.sync.clk_gtp_div2 += [
+            dac_alarm_gtp_r.eq(dac_alarm_gtp),
+            pll_locked_gtp_r.eq(pll_locked_gtp),
+        ]
+
+        self.submodules.cnt = CNT([
+            ("reg", self.sr.bus.re),
+            *[("reg", reg.bus.we) for reg in regs],
+            *[("reg", self.sr.bus.re & (self.sr.bus.adr == adr))
+              for adr in range(len(regs), len(regs) + 5)],
+            ("dac_clk", fsm.before_entering("PLAY")),
+            ("dac_clk", pattern_end),
+            ("clk_gtp_div2", ~pll_locked_gtp & pll_locked_gtp_r),
+            ("clk_gtp_div2", dac_alarm_gtp & ~dac_alarm_gtp_r),
+        ])
+        self.sr.connect(self.cnt.bus, adr=0b0100000, mask=0b1100000)
+
+        # Interrupt line
+
+        trf_ld_gtp = Signal(2)
+        trf_ld_gtp_r = Signal(2)
+        seq_busy_r = Signal()
+        self.specials += MultiReg(trf_ld, trf_ld_gtp, "clk_gtp_div2")
+        self.sync.clk_gtp_div2 += trf_ld_gtp_r.eq(trf_ld_gtp)
+        self.sync.dac_clk += seq_busy_r.eq(self.spi_seq.busy)
+        self.submodules.irq = IRQ([
+            ("clk_gtp_div2", pll_locked_gtp != pll_locked_gtp_r),
+            ("clk_gtp_div2", dac_alarm_gtp & ~dac_alarm_gtp_r),
+            ("clk_gtp_div2", trf_ld_gtp[0] != trf_ld_gtp_r[0]),
+            ("clk_gtp_div2", trf_ld_gtp[1] != trf_ld_gtp_r[1]),
+            ("dac_clk", fsm.before_leaving("PLAY")),
+            ("dac_clk", pattern_end),
+            ("dac_clk", seq_busy_r & ~self.spi_seq.busy),
+        ])
+        self.sr.connect(self.irq.bus, adr=0b0001100, mask=0b1111110)
+        irq_pads = platform.request("lvds", 6)
+        self.specials += DifferentialOutput(self.irq.irq, irq_pads.p, irq_pads.n)
+
+        # Trace buffer
+
+        if trace_depth:
+            trace_sample = Record(trace_layout)
+            trace_sample_r = Record(trace_layout)
+            reg_we = PulseSynchronizer("reg", "dac_clk")
+            self.submodules += reg_we
+            self.comb += [
+                reg_we.i.eq(Cat(*[reg.bus.we for reg in regs]) != 0),
+                trace_sample.reg_we.eq(reg_we.o),
+                trace_sample.dac_play.eq(dac_play_dac_clk),
+                trace_sample.play.eq(fsm.ongoing("PLAY")),
+                trace_sample.dac_istr.eq(dac_istr),
+                trace_sample.dac_oe.eq(dac_oe),
+                trace_sample.dac_test_pattern_en.eq(dac_test_pattern_en_dac_clk),
+                trace_sample.sync.eq(sync_r),
+            ]
+            self.specials += [
+                MultiReg(eem[3], trace_sample.cs, "dac_clk"),
+                MultiReg(dac_alarm, trace_sample.dac_alarm, "dac_clk"),
+                MultiReg(trf_ld, trace_sample.trf_ld, "dac_clk"),
+                MultiReg(dac_ext.cs, trace_sample.dac_cs, "dac_clk"),
+                MultiReg(Cat(trf_ext[0].cs, trf_ext[1].cs), trace_sample.trf_cs, "dac_clk"),
+                MultiReg(Cat(att_ext[0].cs, att_ext[1].cs), trace_sample.att_cs, "dac_clk"),
+            ]
+            self.sync.dac_clk += trace_sample_r.raw_bits().eq(trace_sample.raw_bits())
 
+            self.submodules.trace = Trace(trace_sample.raw_bits(), [
+                trace_sample.cs != trace_sample_r.cs,
+                trace_sample.reg_we,
+                trace_sample.play != trace_sample_r.play,
+                trace_sample.dac_istr & ~trace_sample_r.dac_istr,
+                1,
+            ], depth=trace_depth)
+            self.sr.connect(self.trace.bus, adr=0b1000000, mask=0b1111000)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Phaser gateware builder")
     parser.add_argument("--no-compile-gateware", action="store_false", default=True,
                         help="do not compile gateware, just emit Verilog")
     parser.add_argument("--memory-contents", default="sin", help="memory contents")
+    parser.add_argument("--trace-depth", default=0, type=int,
+                        help="trace buffer entries (0: no trace buffer)")
+    parser.add_argument("--sample-rate", default=125., type=float,
+                        help="DAC sample rate in MHz")
+    parser.add_argument("--dds", action="store_true",
+                        help="build the table lookup DDS")
+    parser.add_argument("--iq-mixer", action="store_true",
+                        help="build the IQ mixer (upconverter variant)")
+    parser.add_argument("--compress", action="store_true",
+                        help="store patterns run length and delta encoded")
+    parser.add_argument("--interpolation", default=1, type=int,
+                        choices=[1, 2, 4, 8],
+                        help="play each stored sample this many times "
+                             "longer through the interpolation filter")
     args = parser.parse_args()
     p = Platform()
-    phaser = Phaser(p, memory_contents[args.memory_contents])
+    phaser = Phaser(p, memory_contents[args.memory_contents],
+                    trace_depth=args.trace_depth,
+                    sample_rate=args.sample_rate*1e6,
+                    dds=args.dds, iq_mixer=args.iq_mixer,
+                    compress=args.compress,
+                    interpolation=args.interpolation)
+    for ch, (rows, entries) in sorted(phaser.compression.items()):
+        ratio = rows*64/(entries*72)
+        print("pattern {}: {} rows in {} entries, {:.2f}x{}".format(
+            ch, rows, entries, ratio,
+            ", stored uncompressed" if ratio < 1 else ""))
     p.build(phaser, build_name="phaser", run=args.no_compile_gateware)
 
@@ -0,0 +1,439 @@
+"""Host-side access to the Phaser SPI register map.
+
+See the `Phaser` docstring in `phaser.py` for the register layout.
+"""
+from contextlib import contextmanager
+
+WE = 1 << 16
+
+# register widths of REG0 to REG4 (`REG.write`)
+REG_WIDTHS = [9, 9, 12, 4, 4]
+
+# name: (address, offset, width, kind)
+#
+# rw:     configuration bits, served from the shadow, read back as written
+#         except for READBACK_INVERTED and READBACK_LOST
+# const:  read-only and fixed for a given board, cached after the first read
+# status: read-only and changed by the hardware, never cached
+FIELDS = {
+    "TERM":       (0, 0, 2, "status"),
+    "HW_REV":     (0, 2, 4, "const"),
+    "PROTO_REV":  (0, 6, 2, "const"),
+    "ASSY_VAR":   (0, 8, 1, "const"),
+
+    "LED":        (1, 0, 6, "rw"),
+    "CLK_SEL":    (1, 6, 1, "rw"),
+    "ATT_RSTn":   (1, 7, 2, "rw"),
+
+    "DAC_TXENA":  (2, 0, 1, "rw"),
+    "DAC_SLEEP":  (2, 1, 1, "rw"),
+    "DAC_RESETn": (2, 2, 1, "rw"),
+    "DAC_ALARM":  (2, 3, 1, "status"),
+    "DAC_PLAY":   (2, 4, 1, "rw"),
+    "DAC_IFRSTn": (2, 5, 1, "rw"),
+    "DAC_TESTen": (2, 6, 1, "rw"),
+    "DAC_SYNCen": (2, 7, 1, "rw"),
+    "TRIG_START": (2, 8, 1, "rw"),
+    "TRIG_STOP":  (2, 9, 1, "rw"),
+    "DAC_PRBS":   (2, 10, 2, "rw"),
+
+    "CH0_GAIN":   (3, 0, 2, "rw"),
+    "CH1_GAIN":   (3, 2, 2, "rw"),
+
+    "PWR_SAVE":   (4, 0, 2, "rw"),
+    "LOCK_DET":   (4, 2, 2, "status"),
+}
+
+# rw fields that do not read back as written: DAC_IFRSTn reads back the
+# (active high) DAC interface reset, REG4 reads back REG0 bits 0:2 in
+# place of PWR_SAVE
+READBACK_INVERTED = {"DAC_IFRSTn"}
+READBACK_LOST = {"PWR_SAVE"}
+
+
+# status snapshot register, name: (offset, width)
+STAT = 10
+STAT_FIELDS = {
+    "TERM":      (0, 2),
+    "HW_REV":    (2, 4),
+    "PROTO_REV": (6, 2),
+    "ASSY_VAR":  (8, 1),
+    "DAC_ALARM": (9, 1),
+    "DAC_PLAY":  (10, 1),
+    "LOCK_DET":  (11, 2),
+    "PLL_LOCK":  (13, 1),
+}
+
+# atomic configuration update, BATCH(0), COMMIT(1) / PENDING(1)
+BATCH = 11
+
+# event counters, two addresses (LSB half first) each
+CNT = 32
+CNT_NAMES = [
+    "FRAMES",
+    "REG0_WR", "REG1_WR", "REG2_WR", "REG3_WR", "REG4_WR",
+    "DAC_XFER", "TRF0_XFER", "TRF1_XFER", "ATT0_XFER", "ATT1_XFER",
+    "PLAY", "LOOPS", "PLL_UNLOCK", "DAC_ALARM",
+]
+
+# interrupt line, cause bits
+IRQ = 12
+IRQ_CAUSES = [
+    "PLL_LOCK", "DAC_ALARM", "TRF0_LD", "TRF1_LD",
+    "PLAY_STOP", "LOOP", "SEQ_DONE",
+]
+
+# trace buffer
+TRC = 64
+
+# timed command queue, timed registers
+TQ = 16
+TREG_GAIN = 0
+TREG_SCALE = 1  # + 2*channel, signed Q2.14
+TREG_OFFSET = 2  # + 2*channel, signed
+TREG_ENV_CTRL = 9  # EN, TABLE, LOOP
+TREG_ENV_RISE = 10
+TREG_ENV_HOLD = 11
+TREG_ENV_FALL = 12
+TREG_ENV_TADR = 13
+TREG_ENV_TDAT = 14
+TREG_DDS_CTRL = 15  # EN, INTERP
+TREG_DDS_STEP = 16  # 2**-16 samples per sample
+TREG_MIX_CTRL = 17  # EN
+TREG_MIX_FTW_LO = 18
+TREG_MIX_FTW_HI = 19  # applies FTW
+TREG_MIX_POW = 20  # 2**-16 turns
+TREG_SEQ_FIRE = 21  # first entry
+
+# pattern memory CRC
+CRC = 80
+
+# SPI sequencer, devices
+SEQ = 72
+SEQ_TRF0, SEQ_TRF1, SEQ_ATT0, SEQ_ATT1 = range(4)
+
+
+def spi_word(adr, dat=0, we=False):
+    """Assemble a 24 bit ADR(7), WE(1), DAT(16) SPI transfer."""
+    return (adr << 17) | (WE if we else 0) | (dat & 0xffff)
+
+
+def field_mask(name):
+    adr, offset, width, kind = FIELDS[name]
+    return ((1 << width) - 1) << offset
+
+
+def _kind_mask(adr, kind):
+    mask = 0
+    for name, (f_adr, _, _, f_kind) in FIELDS.items():
+        if f_adr == adr and f_kind == kind:
+            mask |= field_mask(name)
+    return mask
+
+
+def _names_mask(adr, names):
+    return sum(field_mask(name) for name in names if FIELDS[name][0] == adr)
+
+
+def write_trace(f, entries, trigger=None):
+    """Write a `PhaserHost.read_trace()` result as text for `trace2vcd`.
+
+    One `<sample> <dt>` line (hex) per entry, oldest first, and a
+    `trigger <index>` line if there is a trigger entry.
+    """
+    for sample, dt in entries:
+        f.write("{:04x} {:04x}\n".format(sample, dt))
+    if trigger is not None:
+        f.write("trigger {}\n".format(trigger))
+
+
+class ShadowRegisters:
+    """Write-through shadow cache of the configuration registers.
+
+    `xfer(word, length)` runs one SPI transaction and returns the bits
+    shifted in on MISO. The shadow holds the last value written to each
+    `REG.write` field. Field updates are merged into it locally and
+    writes that would not change the register are dropped. Status bits
+    (TERM, DAC_ALARM, LOCK DET) are never cached and always cost a read.
+    Writes to other addresses are cached the same way (as 16 bit words),
+    for the write-only registers that only need to change once in a while
+    (`TimedQueue` TIME and ADR, `SPISeq` START).
+
+    The shadow starts out unknown. A partial update of an unknown register
+    reads it back once to seed the configuration bits (READBACK_INVERTED
+    fields are inverted). READBACK_LOST fields are unknown until written:
+    they read as zero and must be part of any update that seeds their
+    register. Call `invalidate()` after anything else (board reset,
+    another host) touched the registers.
+    """
+    def __init__(self, xfer, widths=REG_WIDTHS):
+        self.xfer = xfer
+        self.widths = widths
+        self._shadow = [None]*len(widths)
+        self._const = [None]*len(widths)
+        self._words = {}
+        self.stats = {
+            "writes": 0,
+            "writes_skipped": 0,
+            "reads": 0,
+            "reads_cached": 0,
+        }
+
+    @property
+    def saved(self):
+        """SPI transactions avoided by the cache."""
+        return self.stats["writes_skipped"] + self.stats["reads_cached"]
+
+    def invalidate(self, adr=None):
+        if adr is None:
+            self._shadow = [None]*len(self.widths)
+            self._const = [None]*len(self.widths)
+            self._words = {}
+        elif adr < len(self.widths):
+            self._shadow[adr] = None
+            self._const[adr] = None
+        else:
+            self._words.pop(adr, None)
+
+    def transfer(self, adr, dat=0, we=False):
+        """One uncached register access."""
+        self.stats["writes" if we else "reads"] += 1
+        return self.xfer(spi_word(adr, dat, we), 24) & 0xffff
+
+    def written(self, adr):
+        """The cached value of `adr` (None: unknown)."""
+        if adr < len(self.widths):
+            return self._shadow[adr]
+        return self._words.get(adr)
+
+    def write(self, adr, value, force=False):
+        if adr < len(self.widths):
+            value &= (1 << self.widths[adr]) - 1
+        else:
+            value &= 0xffff
+        if not force and self.written(adr) == value:
+            self.stats["writes_skipped"] += 1
+            return
+        self.transfer(adr, value, we=True)
+        if adr < len(self.widths):
+            self._shadow[adr] = value
+        else:
+            self._words[adr] = value
+
+    def seed_const(self, adr, value):
+        """Cache the const fields of REG`adr` from a readout elsewhere."""
+        self._const[adr] = value & _kind_mask(adr, "const")
+
+    def read(self, adr):
+        """Register readback with configuration bits from the shadow."""
+        status = _kind_mask(adr, "status")
+        const = _kind_mask(adr, "const")
+        rw = _kind_mask(adr, "rw")
+        if (not status and self._shadow[adr] is not None
+                and (not const or self._const[adr] is not None)):
+            self.stats["reads_cached"] += 1
+            return self._shadow[adr] & rw | (self._const[adr] or 0)
+        value = self.transfer(adr)
+        if const:
+            self._const[adr] = value & const
+        if self._shadow[adr] is not None:
+            value = value & ~rw | self._shadow[adr] & rw
+        else:
+            value ^= _names_mask(adr, READBACK_INVERTED)
+            value &= ~_names_mask(adr, READBACK_LOST)
+        return value
+
+    def get(self, name):
+        adr, offset, width, kind = FIELDS[name]
+        if name in READBACK_LOST and self._shadow[adr] is None:
+            raise ValueError("{} is unknown until written".format(name))
+        if kind == "rw" and self._shadow[adr] is not None:
+            value = self._shadow[adr]
+            self.stats["reads_cached"] += 1
+        elif kind == "const" and self._const[adr] is not None:
+            value = self._const[adr]
+            self.stats["reads_cached"] += 1
+        else:
+            value = self.read(adr)
+        return (value >> offset) & ((1 << width) - 1)
+
+    def update(self, **fields):
+        """Read-modify-write configuration fields, one write per register."""
+        regs = {}
+        for name, value in fields.items():
+            adr, offset, width, kind = FIELDS[name]
+            if kind != "rw":
+                raise ValueError("{} is read-only".format(name))
+            if value >> width:
+                raise ValueError("{} does not fit {}".format(value, name))
+            mask, bits = regs.get(adr, (0, 0))
+            regs[adr] = mask | field_mask(name), bits | value << offset
+        for adr, (mask, bits) in sorted(regs.items()):
+            base = self._shadow[adr]
+            if base is None:
+                lost = _names_mask(adr, READBACK_LOST)
+                if mask == _kind_mask(adr, "rw"):
+                    base = 0
+                elif lost & ~mask:
+                    raise ValueError("REG{} has fields that do not read "
+                                     "back, update them too".format(adr))
+                else:
+                    base = self.read(adr) & _kind_mask(adr, "rw")
+            self.write(adr, base & ~mask | bits)
+
+
+class PhaserHost:
+    """Status, counters, trace, queue, sequencer, CRC and IRQ access.
+
+    All transactions go through the `ShadowRegisters` cache `regs`
+    (configuration fields: `regs.update()`, `regs.get()`).
+    """
+    def __init__(self, xfer, regs=None):
+        self.regs = regs or ShadowRegisters(xfer)
+
+    def status(self):
+        """Read all status bits with a single transaction."""
+        value = self.regs.transfer(STAT)
+        self.regs.seed_const(0, value)
+        return {name: (value >> offset) & ((1 << width) - 1)
+                for name, (offset, width) in STAT_FIELDS.items()}
+
+    def counters(self, clear=False):
+        """Latch (and optionally clear) all event counters and read them.
+
+        The counters wrap at 32 bits. Take differences modulo 2**32 to
+        compute rates.
+        """
+        self.regs.transfer(CNT, 1 | (2 if clear else 0), we=True)
+        values = {}
+        for i, name in enumerate(CNT_NAMES):
+            lo = self.regs.transfer(CNT + 2*i)
+            hi = self.regs.transfer(CNT + 2*i + 1)
+            values[name] = hi << 16 | lo
+        return values
+
+    def arm_trace(self, triggers, post=0):
+        """Arm the trace buffer with a trigger mask (`Trace` CTRL 1:)."""
+        self.regs.transfer(TRC + 1, post, we=True)
+        self.regs.transfer(TRC, triggers << 1 | 1, we=True)
+
+    def read_trace(self):
+        """Read the trace buffer entries in chronological order.
+
+        Returns `(entries, trigger)` where entries are `(sample, dt)`
+        tuples and `trigger` is the index of the trigger entry (or None).
+        """
+        stat = self.regs.transfer(TRC)
+        ptr = self.regs.transfer(TRC + 2)
+        trig = self.regs.transfer(TRC + 6)
+        depth = self.regs.transfer(TRC + 7)
+        # oldest entry at ptr once wrapped
+        start, n = (ptr, depth) if stat & 0b1000 else (0, ptr)
+        self.regs.transfer(TRC + 3, start, we=True)
+        entries = [(self.regs.transfer(TRC + 4), self.regs.transfer(TRC + 5))
+                   for i in range(n)]
+        trigger = (trig - start) % depth if stat & 0b10 else None
+        return entries, trigger
+
+    def now(self):
+        """Latch and read the `dac_clk` cycle counter."""
+        self.regs.transfer(TQ, 0b10, we=True)
+        lo = self.regs.transfer(TQ + 1)
+        hi = self.regs.transfer(TQ + 2)
+        return hi << 16 | lo
+
+    def schedule(self, adr, dat, time=None):
+        """Queue a timed register write at cycle `time` (None: at once).
+
+        TIME and ADR writes are skipped if unchanged since the last
+        command.
+        """
+        if time is not None:
+            self.regs.write(TQ + 1, time & 0xffff)
+            self.regs.write(TQ + 2, (time >> 16) & 0xffff)
+        self.regs.write(TQ + 3, adr | (1 << 15 if time is None else 0))
+        self.regs.transfer(TQ + 4, dat, we=True)
+
+    def queue_status(self, clear=True):
+        """Read (and clear) the LATE/OVF flags and the EMPTY state."""
+        stat = self.regs.transfer(TQ)
+        if clear and stat & 0b11:
+            self.regs.transfer(TQ, 0b01, we=True)
+        return {"LATE": stat & 1, "OVF": (stat >> 1) & 1,
+                "EMPTY": (stat >> 2) & 1}
+
+    def load_sequence(self, adr, words):
+        """Write SPI sequencer entries from `adr` on.
+
+        `words` are `(device, word, length)` with the `length` bits in the
+        LSBs of `word`. The last entry ends the sequence.
+        """
+        self.regs.transfer(SEQ + 3, adr, we=True)
+        for i, (dev, word, length) in enumerate(words):
+            word <<= 32 - length
+            end = i == len(words) - 1
+            self.regs.transfer(SEQ + 4, word & 0xffff, we=True)
+            self.regs.transfer(SEQ + 5, word >> 16, we=True)
+            self.regs.transfer(SEQ + 6, (length - 1) | dev << 5 | end << 7,
+                               we=True)
+
+    def arm_sequence(self, adr, trig=True):
+        """Set the SPI sequence at `adr` as START and fire it on TRIG
+        rising edges (TRIG_EN) if `trig`."""
+        self.regs.write(SEQ + 1, adr | (1 << 15 if trig else 0))
+
+    def fire_sequence(self, adr=None):
+        """Run the SPI sequence at `adr` (None: at START) at once.
+
+        `adr` becomes START, TRIG_EN is kept.
+        """
+        if adr is not None:
+            start = self.regs.written(SEQ + 1)
+            if start is None:
+                start = self.regs.transfer(SEQ + 1)
+            self.regs.write(SEQ + 1, start & 1 << 15 | adr)
+        self.regs.transfer(SEQ, 1, we=True)
+
+    def pattern_crcs(self, timeout=100):
+        """Sweep the pattern memories and read their CRC-32, a to d.
+
+        Compare with `memory_contents.pattern_crc()`.
+        """
+        self.regs.transfer(CRC, 1, we=True)
+        for i in range(timeout):
+            if not self.regs.transfer(CRC) & 1:
+                break
+        else:
+            raise TimeoutError("pattern CRC sweep")
+        crcs = []
+        for i in range(4):
+            lo = self.regs.transfer(CRC + 2 + 2*i)
+            hi = self.regs.transfer(CRC + 3 + 2*i)
+            crcs.append(hi << 16 | lo)
+        return crcs
+
+    def irq_mask(self, *causes):
+        """Enable the interrupt line for `causes` (names in IRQ_CAUSES)."""
+        mask = 0
+        for cause in causes:
+            mask |= 1 << IRQ_CAUSES.index(cause)
+        self.regs.transfer(IRQ, mask, we=True)
+
+    def irq_cause(self):
+        """Read and clear the pending interrupt causes."""
+        cause = self.regs.transfer(IRQ + 1)
+        return {name for i, name in enumerate(IRQ_CAUSES) if cause >> i & 1}
+
+    @contextmanager
+    def batch(self):
+        """Apply all REG0-REG4 writes within the block on a single SCK
+        edge (BATCH register). On an exception the held writes are dropped
+        and the shadow is invalidated."""
+        self.regs.transfer(BATCH, 1, we=True)
+        try:
+            yield self.regs
+        except BaseException:
+            self.regs.transfer(BATCH, 0, we=True)
+            self.regs.invalidate()
+            raise
+        self.regs.transfer(BATCH, 2, we=True)
@@ -0,0 +1,62 @@
+"""Check a captured Phaser DAC lane against its PRBS (REG2 DAC_PRBS).
+
+The lane bits are checked self-synchronized: every bit after the first
+`order` is predicted from the preceding ones by the PRBS recurrence, so no
+seed or alignment is needed. A single bit error causes three mismatches.
+A stuck lane would match trivially and is rejected: a constant capture,
+or `order` consecutive zeros (the all zero state, which never occurs in
+the PRBS).
+"""
+import argparse
+
+import numpy as np
+
+from phaser import PRBS_TAPS
+
+
+def prbs(order, length, seed=1):
+    """`length` bits of the PRBS from the `order` bit state `seed`, as
+    generated by `PRBS` (state bit 0 is the most recent bit)."""
+    n, m = PRBS_TAPS[order]
+    state = [(seed >> i) & 1 for i in range(order)]
+    bits = np.zeros(length, dtype=np.uint8)
+    for i in range(length):
+        new = state[n - 1] ^ state[m - 1]
+        state = [new] + state[:-1]
+        bits[i] = new
+    return bits
+
+
+def check(bits, order):
+    """Return `(mismatches, checked)` for the lane `bits` (0/1 array).
+
+    Raises `ValueError` for a constant capture or one that contains the
+    all zero state.
+    """
+    n, m = PRBS_TAPS[order]
+    bits = np.asarray(bits, dtype=np.uint8)
+    if len(bits) <= n:
+        raise ValueError("capture shorter than {} bits".format(n + 1))
+    if bits.min() == bits.max():
+        raise ValueError("constant capture")
+    ones = np.concatenate([[0], np.cumsum(bits, dtype=np.int64)])
+    if np.any(ones[order:] == ones[:-order]):
+        raise ValueError("capture contains the all zero state")
+    predicted = bits[n - m:len(bits) - m] ^ bits[:len(bits) - n]
+    mismatches = np.count_nonzero(predicted != bits[n:])
+    return mismatches, len(bits) - n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phaser lane PRBS checker")
+    parser.add_argument("order", type=int, choices=sorted(PRBS_TAPS))
+    parser.add_argument("capture", help="lane bits as bytes, first bit at the LSB")
+    args = parser.parse_args()
+    data = np.fromfile(args.capture, dtype=np.uint8)
+    bits = np.unpackbits(data, bitorder="little")
+    try:
+        mismatches, checked = check(bits, args.order)
+    except ValueError as e:
+        raise SystemExit("{}: {}".format(args.capture, e))
+    print("{} mismatches in {} bits, BER ~ {:.3g}".format(
+        mismatches, checked, mismatches/3/max(checked, 1)))
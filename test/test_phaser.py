@@ -0,0 +1,329 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from migen import *
+
+from phaser import (CNT, IRQ, PatternCRC, RowDecoder, TimedQueue, SPISeq,
+                    Trace)
+from memory_contents import (memory_contents, pattern_crc, encode_rows,
+                             decode_rows, to_mem_row)
+
+
+def bus_write(bus, adr, dat):
+    yield bus.adr.eq(adr)
+    yield bus.dat_w.eq(dat)
+    yield bus.we.eq(1)
+    yield
+    yield bus.we.eq(0)
+
+
+def bus_read(bus, adr):
+    # as `SR`: the address settles (through registered memory read
+    # ports), then `dat_r` is sampled on the `re` edge
+    yield bus.adr.eq(adr)
+    yield
+    yield
+    value = yield bus.dat_r
+    yield bus.re.eq(1)
+    yield
+    yield bus.re.eq(0)
+    return value
+
+
+def test_pattern_crc():
+    words = [[0x0123456789abcdef*(i + 1) & (1 << 64) - 1 for i in range(7)],
+             [(0x5a << 64 | 0x0f1e2d3c4b5a6978)*i & (1 << 72) - 1
+              for i in range(5)]]
+    widths = [64, 72]
+
+    class DUT(Module):
+        def __init__(self):
+            self.submodules.crc = PatternCRC(
+                [(w, len(d)) for w, d in zip(widths, words)], cd="sys")
+            for w, d, adr, dat in zip(widths, words, self.crc.adr,
+                                      self.crc.dat):
+                mem = Memory(w, len(d), init=d)
+                port = mem.get_port(clock_domain="sys")
+                self.specials += mem, port
+                self.comb += [port.adr.eq(adr), dat.eq(port.dat_r)]
+
+    dut = DUT()
+    crcs = []
+
+    def gen():
+        yield from bus_write(dut.crc.bus, 0, 1)
+        assert (yield from bus_read(dut.crc.bus, 0))
+        for _ in range(20):
+            yield
+        assert not (yield from bus_read(dut.crc.bus, 0))
+        for i in range(2):
+            lo = yield from bus_read(dut.crc.bus, 2 + 2*i)
+            hi = yield from bus_read(dut.crc.bus, 3 + 2*i)
+            crcs.append(hi << 16 | lo)
+
+    run_simulation(dut, gen(), clocks={"sys": 10, "reg": 10})
+    assert crcs == [pattern_crc(d, w) for w, d in zip(widths, words)]
+
+
+def test_pattern_crc_dds():
+    """The CRC sweep borrows the DDS memory port in the full design."""
+    from bench import PhaserSim, spi_word
+
+    sim = PhaserSim("sin", dds=True)
+    crcs = []
+
+    def gen():
+        yield from sim.sys.tick(4)
+        yield from sim.frame(spi_word(80, 1, we=True))
+        while (yield from sim.frame(spi_word(80))) & 1:
+            pass
+        for i in range(4):
+            lo = yield from sim.frame(spi_word(82 + 2*i))
+            hi = yield from sim.frame(spi_word(83 + 2*i))
+            crcs.append((hi & 0xffff) << 16 | lo & 0xffff)
+
+    sim.run({"sys": gen()})
+    pattern = memory_contents["sin"]
+    assert crcs == [pattern_crc(pattern[ch][:pattern["length"]//4])
+                    for ch in "abcd"]
+
+
+def test_row_decoder():
+    # a raw run, single rows, a delta run and the wrap to the first row
+    rows = ([to_mem_row([1, 2, 3, 4])]*3
+            + [to_mem_row([5*i, 0xffff - i, 7, i*i]) for i in range(4)]
+            + [to_mem_row([20 + 3*i, 9 - i, 7, 0]) for i in range(5)] + [0])
+    entries = encode_rows(rows)
+    assert len(entries) < len(rows)
+    assert decode_rows(entries) == rows
+
+    dut = RowDecoder(entries, cd="sys")
+    out = []
+
+    def gen():
+        yield dut.start.eq(1)
+        yield dut.run.eq(1)
+        yield
+        yield dut.start.eq(0)
+        yield
+        for _ in range(2*len(rows)):
+            yield
+            out.append((yield dut.o))
+
+    run_simulation(dut, gen())
+    assert out == rows*2
+
+
+def test_timed_queue():
+    dut = TimedQueue(cd="sys")
+    issued = []
+    stat = []
+
+    def writer():
+        # two timed commands, then an IMM and a late one behind them
+        for time, adr, dat in [(100, 5, 0x1234), (110, 6, 0x55),
+                               (50, 1 << 15 | 7, 0xaa), (60, 8, 1)]:
+            yield from bus_write(dut.bus, 1, time)
+            yield from bus_write(dut.bus, 3, adr)
+            yield from bus_write(dut.bus, 4, dat)
+        stat.append((yield from bus_read(dut.bus, 0)))
+        for _ in range(150):
+            yield
+        stat.append((yield from bus_read(dut.bus, 0)))
+
+    def monitor():
+        for _ in range(150):
+            if (yield dut.out.we):
+                issued.append(((yield dut.now), (yield dut.out.adr),
+                               (yield dut.out.dat_w)))
+            yield
+
+    run_simulation(dut, {"reg": writer(), "sys": monitor()},
+                   clocks={"sys": 10, "reg": 10})
+    assert issued == [(100, 5, 0x1234), (110, 6, 0x55), (111, 7, 0xaa),
+                      (112, 8, 1)]
+    assert stat == [0, 0b101]  # LATE and EMPTY
+
+
+def test_spi_seq():
+    dut = SPISeq(depth=16, cd="sys")
+    words = []
+    armed = []
+
+    def entry(adr, dat, length, dev, end=False):
+        yield from bus_write(dut.bus, 3, adr)
+        yield from bus_write(dut.bus, 4, dat & 0xffff)
+        yield from bus_write(dut.bus, 5, dat >> 16)
+        yield from bus_write(dut.bus, 6, length - 1 | dev << 5 | end << 7)
+
+    def writer():
+        yield from entry(0, 0xa5 << 24, 8, 1)
+        yield from entry(1, 0xabc << 20, 12, 2, end=True)
+        yield from entry(5, 0b11 << 30, 2, 0, end=True)
+        yield from bus_write(dut.bus, 2, 0)  # DIV
+        yield from bus_write(dut.bus, 0, 1)  # FIRE
+        for _ in range(8):
+            yield
+        assert (yield from bus_read(dut.bus, 0))
+        while (yield from bus_read(dut.bus, 0)):
+            pass
+        yield from bus_write(dut.bus, 1, 1 << 15 | 5)  # TRIG_EN
+        for _ in range(4):
+            yield
+        armed.append(True)
+
+    def trig():
+        while not armed:
+            yield
+        yield dut.trig.eq(1)
+        yield
+        yield dut.trig.eq(0)
+        for _ in range(40):
+            yield
+
+    def monitor():
+        # sample sdi on the rising sck edges, a word ends with cs
+        bits = [[] for _ in dut.ext]
+        last = [(0, 0)]*len(dut.ext)
+        for _ in range(400):
+            for i, ext in enumerate(dut.ext):
+                cs, sck = (yield ext.cs), (yield ext.sck)
+                if sck and not last[i][1]:
+                    bits[i].append(str((yield ext.sdi)))
+                if last[i][0] and not cs:
+                    words.append((i, int("".join(bits[i]), 2), len(bits[i])))
+                    bits[i] = []
+                last[i] = cs, sck
+            yield
+
+    run_simulation(dut, {"reg": writer(), "sys": [monitor(), trig()]},
+                   clocks={"sys": 10, "reg": 10})
+    assert words == [(1, 0xa5, 8), (2, 0xabc, 12), (0, 0b11, 2)]
+
+
+def test_irq():
+    events = [Signal(), Signal()]
+    dut = IRQ([("sys", events[0]), ("reg", events[1])], cd="sys")
+    fire = []
+    log = []
+
+    def settle():
+        for _ in range(8):
+            yield
+
+    def writer():
+        yield from bus_write(dut.bus, 0, 0b01)  # MASK
+        yield events[1].eq(1)
+        yield
+        yield events[1].eq(0)
+        yield from settle()
+        log.append((yield dut.irq))  # masked
+        log.append((yield from bus_read(dut.bus, 1)))
+        yield from settle()
+        log.append((yield from bus_read(dut.bus, 1)))  # cleared
+        fire.append(True)
+        yield from settle()
+        log.append((yield dut.irq))
+        log.append((yield from bus_read(dut.bus, 1)))
+        yield from settle()
+        log.append((yield dut.irq))
+        log.append((yield from bus_read(dut.bus, 1)))
+
+    def event():
+        while not fire:
+            yield
+        yield events[0].eq(1)
+        yield
+        yield events[0].eq(0)
+
+    run_simulation(dut, {"reg": writer(), "sys": event()},
+                   clocks={"sys": 10, "reg": 10})
+    assert log == [0, 0b10, 0, 1, 0b01, 0, 0]
+
+
+def test_cnt():
+    events = [Signal(), Signal()]
+    dut = CNT([("sys", events[0]), ("reg", events[1])])
+    pulses = []
+    reads = []
+
+    def pulse(event, n):
+        for _ in range(n):
+            yield event.eq(1)
+            yield
+            yield event.eq(0)
+            yield
+
+    def readout():
+        for _ in range(8):
+            yield
+        halves = []
+        for i in range(4):
+            halves.append((yield from bus_read(dut.bus, i)))
+        reads.append(halves)
+
+    def writer():
+        yield from pulse(events[1], 3)
+        pulses.append(5)
+        for _ in range(20):
+            yield
+        yield from bus_write(dut.bus, 0, 0b01)  # latch
+        yield from readout()
+        yield from bus_write(dut.bus, 0, 0b10)  # clear
+        yield from pulse(events[1], 2)
+        yield from bus_write(dut.bus, 0, 0b01)
+        yield from readout()
+
+    def source():
+        while not pulses:
+            yield
+        yield from pulse(events[0], pulses[0])
+
+    run_simulation(dut, {"reg": writer(), "sys": source()},
+                   clocks={"sys": 10, "reg": 10})
+    assert reads == [[5, 0, 3, 0], [0, 0, 2, 0]]
+
+
+def test_trace():
+    sample = Signal(4)
+    trig = Signal()
+    dut = Trace(sample, [trig], depth=16, cd="sys")
+    armed = []
+    stat = []
+    entries = []
+
+    def writer():
+        yield from bus_write(dut.bus, 1, 2)  # POST
+        yield from bus_write(dut.bus, 0, 0b11)  # ARM, trigger 0
+        for _ in range(4):
+            yield
+        armed.append(True)
+        for _ in range(60):
+            yield
+        for adr in 0, 6, 2:  # STAT, TRIG, PTR
+            stat.append((yield from bus_read(dut.bus, adr)))
+        yield from bus_write(dut.bus, 3, 0)
+        for _ in range(stat[-1]):
+            entries.append(((yield from bus_read(dut.bus, 4)),
+                            (yield from bus_read(dut.bus, 5))))
+
+    def source():
+        while not armed:
+            yield
+        # sample, trigger, cycles
+        for value, t, n in [(1, 0, 3), (2, 0, 5), (2, 1, 4), (5, 0, 2),
+                            (6, 0, 7), (7, 0, 2)]:
+            yield sample.eq(value)
+            yield trig.eq(t)
+            yield
+            yield trig.eq(0)
+            for _ in range(n - 1):
+                yield
+
+    run_simulation(dut, {"reg": writer(), "sys": source()},
+                   clocks={"sys": 10, "reg": 10})
+    assert stat == [0b110, 2, 5]  # TRIGD and DONE after POST entries
+    assert [s for s, dt in entries] == [1, 2, 2, 5, 6]
+    assert [dt for s, dt in entries[1:]] == [2, 4, 3, 1]
@@ -0,0 +1,234 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from phaser_host import (ShadowRegisters, PhaserHost, REG_WIDTHS, BATCH, SEQ,
+                         TQ, TRC, field_mask, spi_word, write_trace)
+
+
+class Board:
+    """REG0-REG4 and BATCH as seen over SPI, with the readout of
+    `Phaser`: REG2 bit 5 inverted, REG4 bits 0:2 from REG0."""
+    def __init__(self, const=0x0a4, alarm=0, ld=0b10):
+        self.write = [0]*len(REG_WIDTHS)
+        self.held = {}
+        self.batch = False
+        self.const, self.alarm, self.ld = const, alarm, ld
+        self.other = {}
+        self.log = []
+
+    def readout(self, adr):
+        w = self.write
+        if adr == 0:
+            return self.const
+        if adr == 2:
+            return (w[2] & ~(1 << 3)) ^ 1 << 5 | self.alarm << 3
+        if adr == 4:
+            return w[0] & 0b11 | self.ld << 2
+        return w[adr]
+
+    def xfer(self, word, length):
+        assert length == 24
+        adr, we, dat = word >> 17, word >> 16 & 1, word & 0xffff
+        self.log.append((adr, we, dat))
+        if not we:
+            if adr < len(self.write):
+                return self.readout(adr)
+            return self.other.get(adr, 0)
+        if adr == BATCH:
+            if dat & 2:
+                for i, value in self.held.items():
+                    self.write[i] = value
+            if dat & 3 != 1:
+                self.held = {}
+            self.batch = bool(dat & 1)
+        elif adr < len(self.write):
+            value = dat & ((1 << REG_WIDTHS[adr]) - 1)
+            if self.batch:
+                self.held[adr] = value
+            else:
+                self.write[adr] = value
+        else:
+            self.other[adr] = dat
+        return 0
+
+    def writes(self, adr):
+        return [dat for a, we, dat in self.log if a == adr and we]
+
+
+@pytest.fixture
+def board():
+    return Board()
+
+
+def test_spi_word():
+    assert spi_word(2, 0x1234, we=True) == 2 << 17 | 1 << 16 | 0x1234
+    assert spi_word(127, 0x12345) == 127 << 17 | 0x2345
+
+
+def test_write_skips_unchanged(board):
+    regs = ShadowRegisters(board.xfer)
+    regs.write(1, 0x1ff)
+    regs.write(1, 0x1ff)
+    regs.write(1, 0x3ff)  # masked to the register width
+    assert board.writes(1) == [0x1ff]
+    assert regs.stats["writes_skipped"] == 2
+
+
+def test_seed_inverts_ifrstn(board):
+    board.write[2] = 1 << 5 | 1 << 2 | 1  # IFRSTn, RESETn, TXENA
+    regs = ShadowRegisters(board.xfer)
+    assert regs.read(2) & field_mask("DAC_IFRSTn")
+    regs.update(DAC_PLAY=1)
+    assert board.write[2] == 1 << 5 | 1 << 4 | 1 << 2 | 1
+    assert regs.get("DAC_IFRSTn") == 1
+
+
+def test_seed_masks_status(board):
+    board.alarm = 1
+    board.write[2] = 1
+    regs = ShadowRegisters(board.xfer)
+    regs.update(DAC_SLEEP=1)
+    assert board.write[2] == 0b11
+    assert regs.get("DAC_ALARM") == 1
+
+
+def test_lost_field(board):
+    board.write[0] = 0b11
+    board.write[4] = 0b01
+    regs = ShadowRegisters(board.xfer)
+    assert regs.read(4) == board.ld << 2
+    with pytest.raises(ValueError):
+        regs.get("PWR_SAVE")
+    regs.update(PWR_SAVE=0b10)
+    assert board.write[4] == 0b10
+    assert regs.get("PWR_SAVE") == 0b10
+    assert regs.read(4) == 0b10 | board.ld << 2
+
+
+def test_full_update_does_not_read(board):
+    regs = ShadowRegisters(board.xfer)
+    regs.update(LED=0x3f, CLK_SEL=1, ATT_RSTn=3)
+    assert [we for _, we, _ in board.log] == [1]
+    assert board.write[1] == 0x1ff
+
+
+def test_update_read_only(board):
+    regs = ShadowRegisters(board.xfer)
+    with pytest.raises(ValueError):
+        regs.update(DAC_ALARM=1)
+    with pytest.raises(ValueError):
+        regs.update(LED=0x40)
+
+
+def test_batch(board):
+    host = PhaserHost(board.xfer)
+    with host.batch() as regs:
+        regs.write(1, 0x15)
+        regs.write(3, 0xa)
+        assert board.write[1] == 0 and board.write[3] == 0
+    assert board.write[1] == 0x15 and board.write[3] == 0xa
+    assert not board.batch
+    assert regs.get("LED") == 0x15
+    assert len(board.log) == 4
+
+
+def test_batch_exception(board):
+    host = PhaserHost(board.xfer)
+    regs = host.regs
+    regs.write(1, 0x15)
+    with pytest.raises(RuntimeError):
+        with host.batch():
+            regs.write(1, 0x2a)
+            raise RuntimeError
+    assert board.write[1] == 0x15
+    assert not board.batch
+    assert regs.get("LED") == 0x15  # shadow invalidated, read back
+    assert board.log[-1] == (1, 0, 0)
+
+
+def test_fire_sequence_keeps_trig_en(board):
+    host = PhaserHost(board.xfer)
+    host.arm_sequence(3)
+    host.fire_sequence(7)
+    assert board.other[SEQ + 1] == 1 << 15 | 7
+    host.arm_sequence(7, trig=False)
+    host.fire_sequence(9)
+    assert board.other[SEQ + 1] == 9
+    assert board.writes(SEQ) == [1, 1]
+
+
+def test_fire_sequence_reads_trig_en(board):
+    board.other[SEQ + 1] = 1 << 15 | 2
+    host = PhaserHost(board.xfer)
+    host.fire_sequence(5)
+    assert board.other[SEQ + 1] == 1 << 15 | 5
+    host.fire_sequence(5)
+    assert board.writes(SEQ + 1) == [1 << 15 | 5]
+
+
+def test_schedule_skips_unchanged(board):
+    host = PhaserHost(board.xfer)
+    host.schedule(5, 1, time=0x12345)
+    host.schedule(5, 2, time=0x12346)
+    host.schedule(5, 3)
+    assert board.writes(TQ + 1) == [0x2345, 0x2346]
+    assert board.writes(TQ + 2) == [1]
+    assert board.writes(TQ + 3) == [5, 1 << 15 | 5]
+    assert board.writes(TQ + 4) == [1, 2, 3]
+    host.regs.invalidate()
+    host.schedule(5, 4, time=0x12346)
+    assert board.writes(TQ + 1) == [0x2345, 0x2346, 0x2346]
+
+
+def test_trace_to_vcd(board):
+    from trace2vcd import read_dump, write_vcd
+
+    # wrapped buffer: oldest entry at PTR=1, trigger entry at 2
+    mem = [(0x210, 9), (0x001, 5), (0x011, 3), (0x010, 0)]
+    board.other.update({TRC: 0b1110, TRC + 2: 1, TRC + 6: 2, TRC + 7: 4})
+    xfer = board.xfer
+
+    def trace_xfer(word, length):
+        adr, we = word >> 17, word >> 16 & 1
+        ptr = board.other.get(TRC + 3, 0)
+        if not we and adr == TRC + 4:
+            return mem[ptr][0]
+        if not we and adr == TRC + 5:
+            board.other[TRC + 3] = (ptr + 1) % len(mem)
+            return mem[ptr][1]
+        return xfer(word, length)
+
+    entries, trigger = PhaserHost(trace_xfer).read_trace()
+    assert entries == mem[1:] + mem[:1] and trigger == 1
+
+    dump = io.StringIO()
+    write_trace(dump, entries, trigger)
+    dump.seek(0)
+    assert read_dump(dump) == (entries, trigger)
+
+    dump.seek(0)
+    vcd = io.StringIO()
+    write_vcd(vcd, *read_dump(dump), period=32.)
+    ids = {}
+    changes = {}
+    for line in vcd.getvalue().splitlines():
+        if line.startswith("$var"):
+            _, _, width, vid, name, _ = line.split()
+            ids[vid] = name
+        elif line.startswith("#"):
+            t = int(line[1:])
+            changes[t] = {}
+        elif changes:
+            value, vid = line.split() if " " in line else (line[0], line[1:])
+            changes[t][ids[vid]] = int(value.lstrip("b"), 2)
+    assert sorted(changes) == [0, 128000, 160000, 480000]
+    assert changes[0]["cs"] == 1 and changes[0]["dac_istr"] == 0
+    assert changes[0]["trigger"] == 0
+    assert changes[128000] == {"dac_istr": 1, "trigger": 1}
+    assert changes[160000] == {"cs": 0, "trigger": 0}
+    assert changes[480000] == {"trf_ld": 2}
@@ -0,0 +1,436 @@
+"""Pre-synthesis logic depth and fan-out estimate for the Phaser gateware.
+
+Walks the lowered Migen fragment and estimates, for every register (and
+clocked primitive input), the arrival time of its D input from the
+registers launching it. Combinational logic is packed into LUT6 levels
+by the number of input bits each output bit depends on, carry chains and
+DSP multipliers are costed separately, and high fan-out nets add routing
+delay. The delays are rough XC7A100T-3 numbers: the result ranks paths,
+it does not replace Vivado timing.
+
+Clock periods are taken from the period constraints of the design.
+Paths between domains of the same clock (`sck`/`sys`/`reg`, `dac_clk`/
+`dac_clk_nr`) are timed, half a period for opposite edges; paths between
+unrelated clocks are synchronized and ignored. Fabric logic only reaches
+`dac_clk4x` through the OSERDES `D` inputs, which are captured on
+`CLKDIV` (`dac_clk`).
+
+Exits non-zero if any path has less than `--margin` ns slack.
+"""
+import argparse
+import json
+import math
+import sys
+
+from migen import *
+from migen.fhdl.structure import (_Assign, _Operator, _Slice, _Part,
+                                  _Fragment)
+from migen.fhdl.specials import Instance, Memory
+from migen.fhdl.tools import (lower_complex_slices, insert_resets,
+                              lower_basics, lower_specials, list_signals,
+                              list_special_ios, value_bits_sign)
+from migen.fhdl.namer import build_namespace
+from migen.build.xilinx import common
+
+from phaser import Phaser
+from phaser_impl import Platform
+from memory_contents import memory_contents
+
+
+# ns
+T_CQ = 0.45  # FF clock to output
+T_SU = 0.15  # FF setup and clock uncertainty
+T_LUT = 0.55  # LUT6 and a local route
+T_CARRY4 = 0.12
+T_BRAM = 2.2  # RAMB36 clock to output, no output register
+T_DSP = 3.4  # combinational DSP48E1 multiply
+T_FANOUT = 0.1  # per doubling of the load count
+
+LUT_INPUTS = 6
+CLOCK_PINS = ("CLKDIV", "CLK", "C")
+CLOCK_BUFFERS = ("BUFG", "IBUFDS", "IBUFG", "IBUFGDS")
+
+
+def lut_levels(support):
+    levels = 0
+    while support > 1:
+        support = -(-support // LUT_INPUTS)
+        levels += 1
+    return levels
+
+
+class Cone:
+    """Fan-in cone of an output bit: number of input bits it depends on
+    (`support`) and, per launching clock domain, the latest arrival as
+    `(ns, logic levels, critical signals)`."""
+    def __init__(self, support=0, arrival=None):
+        self.support = support
+        self.arrival = arrival or {}
+
+    @classmethod
+    def merge(cls, cones, support=None):
+        arrival = {}
+        for cone in cones:
+            for cd, a in cone.arrival.items():
+                if cd not in arrival or a[0] > arrival[cd][0]:
+                    arrival[cd] = a
+        if support is None:
+            support = sum(cone.support for cone in cones)
+        return cls(support, arrival)
+
+    def close(self, ns=0., levels=0):
+        """Map the cone into LUTs, followed by `ns`/`levels` of other
+        logic, and return the resulting single bit net."""
+        n = lut_levels(self.support)
+        return Cone(1, {cd: (a + n*T_LUT + ns, lv + n + levels, path)
+                        for cd, (a, lv, path) in self.arrival.items()})
+
+    def via(self, sig, ns=0.):
+        return Cone(self.support, {cd: (a + ns, lv, path + (sig,))
+                                   for cd, (a, lv, path) in self.arrival.items()})
+
+
+class Analyzer:
+    def __init__(self, fragment, clocks, overrides={}):
+        f = _Fragment()
+        f += fragment
+        f = lower_complex_slices(f)
+        insert_resets(f)
+        f = lower_basics(f)
+        f, lowered = lower_specials(overrides, f)
+        f = lower_basics(f)
+        self.fragment = f
+        self.specials = f.specials - lowered
+        self.domains = {cd.name: cd for cd in f.clock_domains}
+        self.ns = build_namespace(list_signals(f) | list_special_ios(f, True, True, True))
+
+        self.comb = {}  # signal: [(lo, hi, conditions, value)]
+        self.sync = {}  # signal: (domain, [(lo, hi, conditions, value)])
+        self.loads = {}  # signal: set of reading targets
+        self.launch = {}  # signal: (domain, clock to output)
+        self.clocked_inputs = []  # (domain, name, value)
+        self.async_reads = {}  # signal: (address, depth)
+        for stmt in f.comb:
+            self._collect(stmt, [], self.comb)
+        for cd, stmts in f.sync.items():
+            targets = {}
+            for stmt in stmts:
+                self._collect(stmt, [], targets)
+            for sig, drivers in targets.items():
+                self.sync[sig] = cd, drivers
+                self.launch[sig] = cd, T_CQ
+        for special in self.specials:
+            self._collect_special(special)
+
+        self.roots, self.periods = {}, {}
+        for name, cd in self.domains.items():
+            source, inverted, period = self._clock(cd.clk, clocks)
+            self.roots[name] = source, inverted
+            self.periods[name] = period
+        self._cones = {}
+
+    def name(self, sig):
+        return self.ns.get_name(sig)
+
+    def _domain_of(self, value):
+        if isinstance(value, ClockSignal):
+            return value.cd
+        for name, cd in self.domains.items():
+            if value is cd.clk:
+                return name
+
+    def _add_loads(self, value, target):
+        for sig in list_signals(value):
+            self.loads.setdefault(sig, set()).add(target)
+
+    def _collect(self, stmt, conditions, drivers):
+        if isinstance(stmt, (list, tuple)):
+            for s in stmt:
+                self._collect(s, conditions, drivers)
+        elif isinstance(stmt, _Assign):
+            for sig, lo, hi, value in self._targets(stmt.l, stmt.r):
+                drivers.setdefault(sig, []).append((lo, hi, conditions, value))
+                for v in (value,) + tuple(c for c, _ in conditions):
+                    self._add_loads(v, sig)
+        elif isinstance(stmt, If):
+            cond = (stmt.cond, 1)
+            self._collect(stmt.t, conditions + [cond], drivers)
+            self._collect(stmt.f, conditions + [cond], drivers)
+        elif isinstance(stmt, Case):
+            # every output bit depends on the whole key
+            cond = (stmt.test, len(stmt.test))
+            for body in stmt.cases.values():
+                self._collect(body, conditions + [cond], drivers)
+
+    def _targets(self, l, r):
+        if isinstance(l, Signal):
+            yield l, 0, len(l), r
+        elif isinstance(l, _Slice):
+            for sig, lo, hi, v in self._targets(l.value, r):
+                yield sig, lo + l.start, lo + l.stop, v
+        elif isinstance(l, Cat):
+            offset = 0
+            for part in l.l:
+                n = len(part)
+                for t in self._targets(part, r[offset:offset + n]):
+                    yield t
+                offset += n
+        else:
+            raise TypeError("Unsupported assignment target {}".format(l))
+
+    def _collect_special(self, special):
+        if isinstance(special, Instance):
+            pins = {item.name: item.expr for item in special.items
+                    if isinstance(item, (Instance.Input, Instance.Output))}
+            cd = None
+            for pin in CLOCK_PINS:
+                if pin in pins:
+                    cd = self._domain_of(pins[pin])
+                    if cd is not None:
+                        break
+            for item in special.items:
+                if isinstance(item, Instance.Output):
+                    for sig in list_signals(item.expr):
+                        if cd is not None:
+                            self.launch[sig] = cd, T_CQ
+                elif isinstance(item, Instance.Input) and cd is not None:
+                    if item.name in CLOCK_PINS or item.name in ("CLR", "PRE"):
+                        continue
+                    target = "{}.{}".format(special.of, item.name)
+                    self.clocked_inputs.append((cd, target, item.expr))
+                    self._add_loads(item.expr, target)
+        elif isinstance(special, Memory):
+            bram = special.width*special.depth > 64*64
+            for port in special.ports:
+                cd = self._domain_of(port.clock)
+                target = self.name(port.dat_r)
+                if port.async_read:
+                    self.async_reads[port.dat_r] = port.adr, special.depth
+                    self._add_loads(port.adr, port.dat_r)
+                else:
+                    self.launch[port.dat_r] = cd, T_BRAM if bram else T_CQ
+                    self.clocked_inputs.append((cd, target + ".adr", port.adr))
+                    self._add_loads(port.adr, target)
+                for value in (port.we, port.dat_w, port.re):
+                    if value is not None:
+                        self.clocked_inputs.append((cd, target, value))
+                        self._add_loads(value, target)
+
+    def _clock(self, sig, constraints):
+        """Follow buffers and inverters back to the clock source, return
+        `(source, inverted, period)`. The outputs of a PLL share its
+        instance as source."""
+        inverted, period = False, None
+        for _ in range(16):
+            if period is None:
+                period = constraints.get(sig)
+            driver = None
+            for lo, hi, conditions, value in self.comb.get(sig, []):
+                if not conditions:
+                    driver = value
+            for special in self.specials:
+                if not isinstance(special, Instance):
+                    continue
+                pins = {i.name: i.expr for i in special.items
+                        if isinstance(i, Instance.Output)}
+                if special.of in CLOCK_BUFFERS and pins.get("O") is sig:
+                    driver = {i.name: i.expr for i in special.items}["I"]
+                elif special.of.startswith("PLL") and sig in pins.values():
+                    return special, inverted, period
+            if isinstance(driver, _Operator) and driver.op == "~":
+                inverted = not inverted
+                driver = driver.operands[0]
+            if not isinstance(driver, Signal):
+                break
+            sig = driver
+        return sig, inverted, period
+
+    def budget(self, launch, capture):
+        """Time available from a `launch` to a `capture` domain edge, None
+        for unrelated clocks."""
+        (ls, li), (cs, ci) = self.roots[launch], self.roots[capture]
+        lp, cp = self.periods[launch], self.periods[capture]
+        if ls is not cs or lp is None or cp is None:
+            return None
+        if li != ci:
+            return min(lp, cp)/2
+        return min(lp, cp)
+
+    def _fanout_ns(self, sig):
+        return T_FANOUT*math.log2(max(len(self.loads.get(sig, ())), 1))
+
+    def signal(self, sig):
+        if sig in self._cones:
+            cone = self._cones[sig]
+            if cone is None:  # combinational loop through the signal
+                return Cone(1)
+            return cone
+        self._cones[sig] = None
+        if sig in self.launch:
+            cd, ns = self.launch[sig]
+            cone = Cone(1, {cd: (ns, 0, (sig,))})
+        elif sig in self.async_reads:
+            adr, depth = self.async_reads[sig]
+            levels = 1 + lut_levels(-(-depth // 64))
+            cone = self.expr(adr).close(levels*T_LUT, levels).via(sig)
+        elif sig in self.comb:
+            cone = self.drivers(self.comb[sig])
+            if len(self.loads.get(sig, ())) > 1:
+                cone = cone.close()
+            cone = cone.via(sig, self._fanout_ns(sig))
+        else:
+            cone = Cone(1)  # pads and constants
+        self._cones[sig] = cone
+        return cone
+
+    def drivers(self, drivers):
+        """Cone of a signal assigned (partially) by several statements: a
+        priority mux over the assignments overlapping each bit."""
+        paths = []
+        for lo, hi, conditions, value in drivers:
+            cones = [self.expr(value)]
+            for cond, _ in conditions:
+                c = self.expr(cond)
+                cones.append(Cone(c.support*len(cond), c.arrival))
+            paths.append((lo, hi, Cone.merge(cones)))
+        bounds = sorted({b for lo, hi, _ in paths for b in (lo, hi)})
+        support = max((sum(c.support for lo, hi, c in paths if lo <= b < hi)
+                       for b in bounds), default=0)
+        return Cone.merge([c for _, _, c in paths], support)
+
+    def expr(self, e):
+        if isinstance(e, Constant):
+            return Cone()
+        if isinstance(e, Signal):
+            return self.signal(e)
+        if isinstance(e, ClockSignal):
+            return Cone()
+        if isinstance(e, ResetSignal):
+            return self.signal(self.domains[e.cd].rst)
+        if isinstance(e, _Slice):
+            return self.expr(e.value)
+        if isinstance(e, Replicate):
+            return self.expr(e.v)
+        if isinstance(e, Cat):
+            cones = [self.expr(v) for v in e.l]
+            return Cone.merge(cones, max((c.support for c in cones), default=0))
+        if isinstance(e, _Part):
+            a, b = self.expr(e.value), self.expr(e.offset)
+            return Cone.merge([a, b], a.support*e.width + b.support)
+        if isinstance(e, _Operator):
+            cones = [self.expr(v) for v in e.operands]
+            width = max(value_bits_sign(v)[0] for v in e.operands)
+            if e.op in ("~",):
+                return cones[0]
+            if e.op in ("&", "|", "^", "m"):
+                return Cone.merge(cones)
+            if e.op in ("==", "!="):
+                return Cone.merge(cones, sum(c.support for c in cones)*width)
+            if e.op in ("<<<", ">>>"):
+                if isinstance(e.operands[1], Constant):
+                    return cones[0]
+                return Cone.merge(cones, cones[0].support*width + cones[1].support)
+            if e.op == "*":
+                return Cone.merge([c.close() for c in cones]).close(T_DSP, 1)
+            # carry chain: +, -, <, <=, >, >=
+            chain = -(-width // 4)
+            return Cone.merge([c.close() for c in cones]).close(
+                T_LUT + chain*T_CARRY4, 1 + chain)
+        raise TypeError("Unsupported expression {}".format(e))
+
+    def endpoints(self):
+        for sig, (cd, drivers) in self.sync.items():
+            yield cd, self.name(sig), self.drivers(drivers)
+        for cd, target, value in self.clocked_inputs:
+            yield cd, target, self.expr(value)
+
+    def paths(self):
+        """Worst path per endpoint and launching domain, sorted by slack."""
+        paths = []
+        for capture, target, cone in self.endpoints():
+            for launch, (ns, levels, path) in cone.close().arrival.items():
+                budget = self.budget(launch, capture)
+                if budget is None:
+                    continue
+                arrival = ns + T_SU
+                paths.append({
+                    "launch": launch,
+                    "capture": capture,
+                    "endpoint": target,
+                    "levels": levels,
+                    "arrival": round(arrival, 3),
+                    "budget": budget,
+                    "slack": round(budget - arrival, 3),
+                    "path": [self.name(s) for s in path],
+                })
+        paths.sort(key=lambda p: p["slack"])
+        return paths
+
+    def fanout(self, n=10):
+        loads = sorted(self.loads.items(), key=lambda kv: -len(kv[1]))
+        return [(self.name(sig), len(targets)) for sig, targets in loads[:n]]
+
+
+def analyze(phaser, platform):
+    overrides = dict(common.xilinx_special_overrides)
+    overrides.update(common.xilinx_s7_special_overrides)
+    return Analyzer(phaser.get_fragment(), platform.toolchain.clocks,
+                    overrides)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Phaser logic depth and fan-out estimate")
+    parser.add_argument("--trace-depth", type=int, default=0)
+    parser.add_argument("--sample-rate", type=float, default=125.,
+                        help="DAC sample rate in MS/s")
+    parser.add_argument("--dds", action="store_true")
+    parser.add_argument("--iq-mixer", action="store_true")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--interpolation", type=int, default=1,
+                        choices=[1, 2, 4, 8])
+    parser.add_argument("--margin", type=float, default=0.,
+                        help="flag paths with less slack (ns)")
+    parser.add_argument("-n", type=int, default=5,
+                        help="paths and nets to list per domain")
+    parser.add_argument("--json", help="write the report to a file")
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(20000)
+    platform = Platform()
+    phaser = Phaser(platform, memory_contents["sin"],
+                    trace_depth=args.trace_depth,
+                    sample_rate=args.sample_rate*1e6,
+                    dds=args.dds, iq_mixer=args.iq_mixer,
+                    compress=args.compress,
+                    interpolation=args.interpolation)
+    a = analyze(phaser, platform)
+    paths = a.paths()
+
+    report = {"domains": {}, "fanout": a.fanout(args.n)}
+    for cd in sorted(a.domains):
+        mine = [p for p in paths if p["capture"] == cd]
+        report["domains"][cd] = {
+            "period": a.periods[cd],
+            "endpoints": len(mine),
+            "max_levels": max((p["levels"] for p in mine), default=0),
+            "failing": sum(p["slack"] < args.margin for p in mine),
+            "worst": mine[:args.n],
+        }
+        if not mine:
+            continue
+        print("{}: period {} ns, {} paths, {} below {} ns slack".format(
+            cd, a.periods[cd], len(mine),
+            report["domains"][cd]["failing"], args.margin))
+        for p in mine[:args.n]:
+            print("  {:7.3f} ns slack, {:2d} levels, {} -> {}: {}".format(
+                p["slack"], p["levels"], p["launch"], p["endpoint"],
+                " > ".join(p["path"])))
+    print("fan-out:")
+    for name, n in report["fanout"]:
+        print("  {:5d} {}".format(n, name))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    failing = sum(d["failing"] for d in report["domains"].values())
+    sys.exit(1 if failing else 0)
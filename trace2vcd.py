@@ -0,0 +1,88 @@
+"""Convert a Phaser trace buffer readout to VCD.
+
+The input is a `PhaserHost.read_trace()` result as written by
+`phaser_host.write_trace()`: one entry per line, `<sample> <dt>` in hex,
+oldest first. A line `trigger <index>` marks the trigger entry.
+"""
+import argparse
+
+from phaser import trace_layout
+
+
+def _ids():
+    i = 0
+    while True:
+        n, s = i, ""
+        while True:
+            s += chr(33 + n % 94)
+            n //= 94
+            if not n:
+                break
+        yield s
+        i += 1
+
+
+def write_vcd(f, entries, trigger=None, period=32., layout=trace_layout):
+    """Write `(sample, dt)` entries to `f` as VCD, `period` in ns."""
+    ids = _ids()
+    fields = []
+    offset = 0
+    for name, width in layout:
+        fields.append((name, offset, width, next(ids)))
+        offset += width
+    trig_id = next(ids)
+
+    f.write("$timescale 1ps $end\n")
+    f.write("$scope module phaser $end\n")
+    for name, offset, width, vid in fields:
+        f.write("$var wire {} {} {} $end\n".format(width, vid, name))
+    f.write("$var wire 1 {} trigger $end\n".format(trig_id))
+    f.write("$upscope $end\n")
+    f.write("$enddefinitions $end\n")
+
+    t = 0
+    last = None
+    for i, (sample, dt) in enumerate(entries):
+        if i:
+            t += dt + 1
+        f.write("#{}\n".format(round(t*period*1000)))
+        for name, offset, width, vid in fields:
+            v = (sample >> offset) & ((1 << width) - 1)
+            if last is not None and v == (last >> offset) & ((1 << width) - 1):
+                continue
+            if width == 1:
+                f.write("{}{}\n".format(v, vid))
+            else:
+                f.write("b{:b} {}\n".format(v, vid))
+        if i == 0 or i == trigger or i - 1 == trigger:
+            f.write("{}{}\n".format(int(i == trigger), trig_id))
+        last = sample
+
+
+def read_dump(f):
+    """Read `phaser_host.write_trace()` output, returns `(entries, trigger)`
+    as from `PhaserHost.read_trace()`."""
+    entries = []
+    trigger = None
+    for line in f:
+        line = line.split("#")[0].split()
+        if not line:
+            continue
+        if line[0] == "trigger":
+            trigger = int(line[1])
+        else:
+            entries.append((int(line[0], 16), int(line[1], 16)))
+    return entries, trigger
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phaser trace to VCD")
+    parser.add_argument("dump", help="trace readout")
+    parser.add_argument("vcd", help="VCD output")
+    parser.add_argument("--period", default=32., type=float,
+                        help="dac_clk period in ns")
+    args = parser.parse_args()
+    with open(args.dump) as f:
+        entries, trigger = read_dump(f)
+    with open(args.vcd, "w") as f:
+        write_vcd(f, entries, trigger, args.period)